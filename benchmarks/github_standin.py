@@ -0,0 +1,96 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stand-in for the GitHub API.
+
+Answers every request with a small JSON body so that a proxy can be pointed
+at it (with MAGICPROXY_GITHUB_API_ROOT) and benchmarked without talking to
+GitHub. Requests with an X-Magicproxy-Replay-Size header get a body of that
+many bytes instead, which lets replayed traffic keep its response sizes.
+
+Usage:
+
+    python benchmarks/github_standin.py --port 8081
+"""
+
+import argparse
+import http.server
+import json
+import threading
+
+REPLAY_SIZE_HEADER = "X-Magicproxy-Replay-Size"
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                self.rfile.read(size + 2)
+                if not size:
+                    return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+    def _respond(self):
+        self._read_body()
+
+        replay_size = self.headers.get(REPLAY_SIZE_HEADER)
+        if replay_size is not None:
+            body = b"x" * int(replay_size)
+        else:
+            body = json.dumps({"method": self.command, "path": self.path}).encode(
+                "utf-8"
+            )
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port=0) -> http.server.ThreadingHTTPServer:
+    """Starts the stand-in on a background thread and returns the server."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    server = start(args.port)
+    print(f"GitHub stand-in listening on http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
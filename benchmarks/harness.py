@@ -0,0 +1,84 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for running a proxy against the local GitHub stand-in."""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from magicproxy import magictoken
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA = os.path.join(HERE, "..", "tests", "data")
+PRIVATE_KEY = os.path.join(DATA, "private.pem")
+CERTIFICATE = os.path.join(DATA, "public.x509.cer")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def mint_token(scopes) -> str:
+    """Creates a magic token that the proxies started here will accept."""
+    keys = magictoken.Keys.from_files(PRIVATE_KEY, CERTIFICATE)
+    return magictoken.create(keys, "benchmark", scopes)
+
+
+def start_proxy(server: str, api_root: str, port: int, python_args=(), **kwargs):
+    """Starts ``python -m magicproxy`` in a subprocess.
+
+    Keyword arguments are passed on to :class:`subprocess.Popen`.
+    """
+    env = dict(os.environ)
+    env.update(
+        {
+            "MAGICPROXY_PRIVATE_KEY": PRIVATE_KEY,
+            "MAGICPROXY_PUBLIC_KEY": CERTIFICATE,
+            "MAGICPROXY_GITHUB_API_ROOT": api_root,
+            "PORT": str(port),
+        }
+    )
+    return subprocess.Popen(
+        [sys.executable, *python_args, "-m", "magicproxy", server], env=env, **kwargs
+    )
+
+
+def wait_for_response(proc, url: str, token: str, timeout: float) -> float:
+    """Polls the proxy until a proxied request succeeds.
+
+    Returns:
+        The number of seconds it took.
+    """
+    request = urllib.request.Request(url, headers={"Authorization": f"Bearer {token}"})
+    start = time.perf_counter()
+
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed > timeout:
+            raise RuntimeError(f"No proxied response after {timeout}s.")
+        if proc.poll() is not None:
+            raise RuntimeError(f"Proxy exited with {proc.returncode}.")
+        try:
+            with urllib.request.urlopen(request, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - start
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.005)
@@ -0,0 +1,191 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replays captured traffic against a proxy and the local GitHub stand-in.
+
+Reads a JSONL capture written by a proxy running with
+MAGICPROXY_CAPTURE_FILE and sends the same requests (method, path, body
+size, expected response size) at the original inter-arrival times, scaled by
+``--speed``. Requests that were denied in the capture are sent with a token
+that has no scopes, so the proxy denies them again.
+
+By default a proxy is started against the stand-in; pass ``--proxy`` to
+drive one that's already running (it must use the test keys and point at a
+stand-in).
+
+Usage:
+
+    python benchmarks/replay.py capture.jsonl --server aiohttp --speed 4
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import subprocess
+import threading
+import time
+
+import requests
+
+import github_standin
+import harness
+
+
+def load_capture(capture_file):
+    with open(capture_file, "r", encoding="utf-8") as fh:
+        entries = [json.loads(line) for line in fh if line.strip()]
+    return sorted(entries, key=lambda entry: entry["ts"])
+
+
+class Replayer:
+    def __init__(self, proxy_url: str, allow_token: str, deny_token: str):
+        self.proxy_url = proxy_url.rstrip("/")
+        self.allow_token = allow_token
+        self.deny_token = deny_token
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        # Sessions aren't thread-safe, but reusing one per thread keeps
+        # connections alive the way a real client would.
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def send(self, entry):
+        """Sends one captured request. Returns (latency, status, entry)."""
+        token = self.allow_token if entry["allowed"] else self.deny_token
+        headers = {"Authorization": f"Bearer {token}"}
+        if entry.get("response_size") is not None:
+            headers[github_standin.REPLAY_SIZE_HEADER] = str(entry["response_size"])
+
+        start = time.perf_counter()
+        try:
+            response = self._session().request(
+                entry["method"],
+                self.proxy_url + entry["path"],
+                headers=headers,
+                data=b"x" * entry["body_size"] if entry["body_size"] else None,
+            )
+            response.content
+            status = response.status_code
+        except requests.RequestException:
+            status = None
+        return time.perf_counter() - start, status, entry
+
+
+def replay(replayer: Replayer, entries, speed: float, concurrency: int):
+    """Sends every entry on schedule and returns the results and wall time."""
+    first_ts = entries[0]["ts"]
+    futures = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        for entry in entries:
+            due = (entry["ts"] - first_ts) / speed
+            delay = due - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(replayer.send, entry))
+
+        results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+
+    return results, elapsed
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(results, elapsed, captured_duration, speed):
+    latencies = sorted(latency for latency, _, _ in results)
+    statuses = collections.Counter(status for _, status, _ in results)
+    decision_changes = sum(
+        1
+        for _, status, entry in results
+        if status is not None and (status < 400) != entry["allowed"]
+    )
+
+    print(f"Replayed {len(results)} requests in {elapsed:.2f}s")
+    print(f"  captured duration {captured_duration:.2f}s at {speed}x speed")
+    print(f"  throughput {len(results) / elapsed:.1f} req/s")
+    print(
+        "  latency p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+            *(
+                _percentile(latencies, fraction) * 1000
+                for fraction in (0.5, 0.9, 0.99, 1.0)
+            )
+        )
+    )
+    print(f"  statuses {dict(sorted(statuses.items(), key=str))}")
+    print(f"  scope decisions that differ from the capture: {decision_changes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture_file")
+    parser.add_argument("--server", choices=["flask", "aiohttp"], default="flask")
+    parser.add_argument("--proxy", help="The URL of an already running proxy.")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Replay N times faster than captured.",
+    )
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    entries = load_capture(args.capture_file)
+    if not entries:
+        parser.error(f"{args.capture_file} has no captured requests.")
+
+    allow_token = harness.mint_token(["* .*"])
+    deny_token = harness.mint_token([])
+
+    standin = proc = None
+    proxy_url = args.proxy
+    if proxy_url is None:
+        standin = github_standin.start()
+        port = harness.free_port()
+        proc = harness.start_proxy(
+            args.server,
+            f"http://127.0.0.1:{standin.server_port}",
+            port,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        proxy_url = f"http://127.0.0.1:{port}"
+
+    try:
+        if proc is not None:
+            harness.wait_for_response(
+                proc, f"{proxy_url}/user", allow_token, args.timeout
+            )
+
+        replayer = Replayer(proxy_url, allow_token, deny_token)
+        results, elapsed = replay(replayer, entries, args.speed, args.concurrency)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+            standin.shutdown()
+
+    report(results, elapsed, entries[-1]["ts"] - entries[0]["ts"], args.speed)
+
+
+if __name__ == "__main__":
+    main()
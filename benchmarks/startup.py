@@ -0,0 +1,175 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the time from process start to the first proxied response.
+
+Each run starts the proxy with ``python -X importtime -m magicproxy``, points
+it at a local GitHub stand-in and polls it with a magic token until a
+proxied request succeeds. The median over all runs is compared against the
+median recorded for the server in startup_baseline.json, and fails if it's
+more than ``--margin`` slower. The slowest imports of the app module in the
+last run are printed to show where startup time goes.
+
+Baselines depend on the machine, so record new ones with ``--record`` on the
+machine that runs the check.
+
+Usage:
+
+    python benchmarks/startup.py --server flask
+    python benchmarks/startup.py --server flask --record
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import github_standin
+import harness
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "startup_baseline.json")
+
+
+def _parse_importtime(output: str):
+    """Returns (cumulative_us, module) for each direct import of the app.
+
+    ``-X importtime`` lists a module after everything it imports, indented by
+    two spaces per level. The app module (``magicproxy.proxy`` or
+    ``magicproxy.async_proxy``) is imported at the top level, so its direct
+    imports are the entries one level in that come right before it.
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        name = module.strip()
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        if depth == 1:
+            imports.append((int(cumulative), name))
+        elif depth == 0:
+            if name.startswith("magicproxy."):
+                return imports
+            imports = []
+    return []
+
+
+def measure(server: str, token: str, timeout: float):
+    """Starts the proxy once and returns (seconds, importtime output)."""
+    standin = github_standin.start()
+    port = harness.free_port()
+
+    # importtime output goes to a file rather than a pipe so that the child
+    # can never block on a full pipe while we're polling it.
+    with tempfile.TemporaryFile(mode="w+") as stderr:
+        start = time.perf_counter()
+        proc = harness.start_proxy(
+            server,
+            f"http://127.0.0.1:{standin.server_port}",
+            port,
+            python_args=["-X", "importtime"],
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+        )
+
+        try:
+            harness.wait_for_response(
+                proc, f"http://127.0.0.1:{port}/user", token, timeout
+            )
+            elapsed = time.perf_counter() - start
+        finally:
+            proc.terminate()
+            proc.wait()
+            standin.shutdown()
+
+        stderr.seek(0)
+        return elapsed, stderr.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["flask", "aiohttp"], default="flask")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument(
+        "--margin",
+        type=float,
+        default=0.5,
+        help="Fail if the median is this fraction slower than the baseline.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="Fail if the median exceeds this (seconds) instead of using the baseline.",
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="Record the median as the new baseline for the server.",
+    )
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    token = harness.mint_token(["* .*"])
+
+    timings = []
+    for _ in range(args.runs):
+        elapsed, importtime = measure(args.server, token, args.timeout)
+        timings.append(elapsed)
+
+    median = statistics.median(timings)
+    print(f"Time to first proxied response ({args.server}, {args.runs} runs):")
+    print(
+        f"  median {median * 1000:.0f}ms,"
+        f" min {min(timings) * 1000:.0f}ms,"
+        f" max {max(timings) * 1000:.0f}ms"
+    )
+
+    print("\nSlowest imports of the app module (cumulative):")
+    imports = sorted(_parse_importtime(importtime), reverse=True)
+    for cumulative, module in imports[: args.top]:
+        print(f"  {cumulative / 1000:8.1f}ms  {module}")
+
+    with open(args.baseline, "r", encoding="utf-8") as fh:
+        baselines = json.load(fh)
+
+    if args.record:
+        baselines[args.server] = round(median, 3)
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(baselines, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+        print(f"\nRecorded {median:.3f}s as the {args.server} baseline")
+        return
+
+    if args.threshold is not None:
+        threshold = args.threshold
+    else:
+        baseline = baselines[args.server]
+        threshold = baseline * (1 + args.margin)
+        print(f"\nBaseline {baseline:.3f}s, threshold {threshold:.3f}s")
+
+    if median > threshold:
+        print(f"\nFAIL: median {median:.3f}s exceeds threshold {threshold:.3f}s")
+        sys.exit(1)
+
+    print(f"\nOK: median {median:.3f}s is within threshold {threshold:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -96,6 +96,19 @@ def lint(session):
 
 @nox.session(python="3.7")
 def test(session):
-    session.install("pytest")
-    session.run("pip", "install", "-e", ".")
+    # aiohttp isn't a dependency, but the aiohttp app is tested too.
+    session.install("pytest", "aiohttp")
+    session.run("pip", "install", "-e", ".[http2]")
     session.run("pytest", "tests", *session.posargs)
+
+
+@nox.session(python="3.7")
+def startup_benchmark(session):
+    session.run("pip", "install", "-e", ".")
+    session.run("python", "benchmarks/startup.py", *session.posargs)
+
+
+@nox.session(python="3.7")
+def replay(session):
+    session.run("pip", "install", "-e", ".")
+    session.run("python", "benchmarks/replay.py", *session.posargs)
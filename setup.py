@@ -41,6 +41,7 @@ setup(
     packages=find_packages(where="src"),
     package_dir={"": "src"},
     install_requires=["google-auth", "flask", "cryptography", "attrs", "requests"],
+    extras_require={"http2": ["httpx[http2]"]},
     python_requires=">=3.6",
     project_urls={
         "Bug Reports": "https://github.com/theacodes/magic-github-proxy/issues",
@@ -12,7 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from magicproxy import proxy
+import os
+import sys
+
+
+def main():
+    # Only the selected server framework is imported.
+    if len(sys.argv) > 1:
+        server = sys.argv[1]
+    else:
+        server = os.environ.get("MAGICPROXY_SERVER", "flask")
+
+    if server == "flask":
+        from magicproxy import proxy
+
+        proxy.run_app()
+    elif server == "aiohttp":
+        from magicproxy import async_proxy
+
+        async_proxy.run_app()
+    else:
+        sys.exit(f"Unknown server {server!r}, expected flask or aiohttp.")
+
 
 if __name__ == "__main__":
-    proxy.run_app()
+    main()
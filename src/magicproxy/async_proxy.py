@@ -15,43 +15,131 @@
 import aiohttp
 import aiohttp.web
 
+import asyncio
 import os
+from typing import Dict
 
+from . import capture
+from . import downloads
 from . import magictoken
+from . import profiling
 from . import scopes
-from . import headers
 from . import queries
+from . import tokencache
+from .headers import (
+    clean_download_response_headers,
+    clean_request_headers,
+    clean_response_headers,
+)
 
-GITHUB_API_ROOT = "https://api.github.com"
+GITHUB_API_ROOT = os.environ.get("MAGICPROXY_GITHUB_API_ROOT", "https://api.github.com")
 
 routes = aiohttp.web.RouteTableDef()
 
 query_params_to_clean = set()
 custom_request_headers_to_clean = set()
 
+# Created on import rather than in build_app, which runs in each worker, so
+# that workers forked after the module is loaded share it, see
+# tokencache.from_env.
+token_cache = tokencache.from_env()
+
+# Scope profiles by ref, see scopes.load_profiles.
+scope_profiles: Dict[str, scopes.ScopeProfile] = {}
+
+# Records traffic metadata when set, see capture.from_env.
+capture_writer = None
+
+# Multiplexes requests to GitHub over HTTP/2 when set, see upstream.from_env.
+# The upstream module needs Python 3.7, so it's only imported when enabled.
+http2_upstream = None
+
+# The admin endpoints under /_magicproxy/ are only served when this is set.
+admin_token = None
+
+sampler = profiling.Sampler()
+
+# Traces requests above a duration when set, see profiling.tracer_from_env.
+slow_request_tracer = None
+
+# Whether to time every scope pattern evaluated for a request.
+scope_timing = False
+
 @routes.post("/magictoken")
 async def create_magic_token(request):
     params = await request.json()
 
     if not params:
-        raise aiohttp.web.HTTPInvalidRequest("Request must be json.")
+        raise aiohttp.web.HTTPBadRequest(text="Request must be json.")
 
-    if not isinstance(params.get("scopes"), list):
-        raise aiohttp.web.HTTPInvalidRequest("Scopes must be a list.")
+    scope_profile = params.get("scope_profile")
 
-    token = magictoken.create(keys, params["github_token"], params["scopes"])
+    if scope_profile is not None:
+        if not isinstance(scope_profile, str):
+            raise aiohttp.web.HTTPBadRequest(text="Scope profile must be a string.")
+        if scope_profile not in scope_profiles:
+            raise aiohttp.web.HTTPBadRequest(
+                text="Scope profile is not configured on this proxy."
+            )
+    elif not isinstance(params.get("scopes"), list):
+        raise aiohttp.web.HTTPBadRequest(text="Scopes must be a list.")
+
+    token = magictoken.create(
+        keys,
+        params["github_token"],
+        params.get("scopes"),
+        scope_profile=scope_profile,
+        compact=bool(params.get("compact")),
+    )
 
     return aiohttp.web.Response(body=token, headers={"Content-Type": "application/jwt"})
 
 
 async def _proxy_request(request, url, headers=None, **kwargs):
-    clean_headers = headers.clean_request_headers(request.headers, custom_request_headers_to_clean)
+    """Relays a request to GitHub.
+
+    Returns:
+        The response and the number of body bytes relayed.
+    """
+    clean_headers = clean_request_headers(request.headers, custom_request_headers_to_clean)
 
     if headers:
         clean_headers.update(headers)
 
     print(f"Proxying to {request.method} {url}\n")
 
+    if http2_upstream is not None:
+        from .upstream import UpstreamConnectionError
+
+        proxied_request = http2_upstream.stream(
+            url=url,
+            method=request.method,
+            headers=clean_headers,
+            params=list(request.query.items()),
+            content=await request.read(),
+        )
+        try:
+            async with proxied_request as proxied_response:
+                response_headers = clean_response_headers(proxied_response.headers)
+
+                response = aiohttp.web.StreamResponse(
+                    status=proxied_response.status_code, headers=response_headers
+                )
+
+                await response.prepare(request)
+
+                relayed = 0
+
+                async for data in proxied_response.aiter_bytes():
+                    await response.write(data)
+                    relayed += len(data)
+
+                await response.write_eof()
+
+                return response, relayed
+        except UpstreamConnectionError:
+            raise aiohttp.web.HTTPBadGateway(text="Connection to GitHub failed.")
+
     async with aiohttp.ClientSession() as session:
         proxied_request = session.request(
             url=url,
@@ -62,7 +150,7 @@ async def _proxy_request(request, url, headers=None, **kwargs):
             **kwargs,
         )
         async with proxied_request as proxied_response:
-            response_headers = headers.clean_response_headers(proxied_response.headers)
+            response_headers = clean_response_headers(proxied_response.headers)
 
             response = aiohttp.web.StreamResponse(
                 status=proxied_response.status, headers=response_headers
@@ -70,50 +158,238 @@ async def _proxy_request(request, url, headers=None, **kwargs):
 
             await response.prepare(request)
 
+            relayed = 0
+
             async for data, last in proxied_response.content.iter_chunks():
                 await response.write(data)
+                relayed += len(data)
 
             await response.write_eof()
 
-            return response
+            return response, relayed
+
+
+async def _proxy_download(request, url, headers=None):
+    """Relays a download, following redirects.
+
+    Returns:
+        The response and the number of body bytes relayed.
+    """
+    clean_headers = clean_request_headers(request.headers, custom_request_headers_to_clean)
+
+    if headers:
+        clean_headers.update(headers)
+
+    params = request.query
+
+    # Bodies are relayed as they are, so don't let aiohttp decompress them.
+    async with aiohttp.ClientSession(auto_decompress=False) as session:
+        # Follow redirects here rather than in aiohttp so that the GitHub
+        # token is never sent to another host.
+        for _ in range(downloads.MAX_REDIRECTS + 1):
+            proxied_request = session.request(
+                url=url,
+                method=request.method,
+                headers=clean_headers,
+                params=params,
+                allow_redirects=False,
+            )
+            async with proxied_request as proxied_response:
+                if downloads.is_redirect(proxied_response.status, proxied_response.headers):
+                    url, clean_headers = downloads.follow(
+                        url, clean_headers, proxied_response.headers["Location"]
+                    )
+                    # The redirect target carries its own query string.
+                    params = None
+                    continue
+
+                response = aiohttp.web.StreamResponse(
+                    status=proxied_response.status,
+                    headers=clean_download_response_headers(proxied_response.headers),
+                )
+
+                await response.prepare(request)
+
+                relayed = 0
+
+                # write() waits for the client to drain, so at most a chunk
+                # or two is ever held in memory.
+                async for data in proxied_response.content.iter_chunked(
+                    downloads.CHUNK_SIZE
+                ):
+                    await response.write(data)
+                    relayed += len(data)
+
+                await response.write_eof()
+
+                return response, relayed
+
+    raise aiohttp.web.HTTPBadGateway(text="Too many redirects.")
+
+
+def _finish_request(
+    request, allowed, status, response_size, timer, scope, scope_timings
+):
+    if capture_writer is None and slow_request_tracer is None:
+        return
+
+    captured_path = capture.clean_path(
+        request.path, request.query_string, query_params_to_clean
+    )
+
+    if slow_request_tracer is not None:
+        slow_request_tracer.check(
+            request.method, captured_path, timer, scope_timings, scope
+        )
+
+    if capture_writer is not None:
+        capture_writer.record(
+            capture.entry(
+                method=request.method,
+                path=captured_path,
+                header_names=request.headers.keys(),
+                # Content-Length isn't set for chunked uploads, so count the
+                # bytes that were actually read instead.
+                body_size=request.content.total_bytes,
+                allowed=allowed,
+                status=status,
+                response_size=response_size,
+                timer=timer,
+            )
+        )
+
+
+def _check_admin(request):
+    """Raises unless the request has the admin token."""
+    if not admin_token:
+        raise aiohttp.web.HTTPNotFound()
+
+    if not profiling.check_admin_token(admin_token, request.headers.get("Authorization")):
+        raise aiohttp.web.HTTPUnauthorized(text="Admin token required.")
+
+
+@routes.get("/_magicproxy/profile")
+async def profile(request):
+    _check_admin(request)
+
+    try:
+        seconds = float(request.query.get("seconds", 10))
+    except ValueError:
+        raise aiohttp.web.HTTPBadRequest(text="seconds must be a number")
+
+    # Sample from another thread so the event loop keeps serving requests
+    # (and shows up in the profile).
+    loop = asyncio.get_event_loop()
+    try:
+        stacks = await loop.run_in_executor(
+            None, sampler.sample, min(seconds, profiling.MAX_PROFILE_SECONDS)
+        )
+    except profiling.ProfilerBusy:
+        raise aiohttp.web.HTTPConflict(text="A profile is already running.")
+
+    return aiohttp.web.Response(text=stacks)
+
+
+@routes.get("/_magicproxy/slow-requests")
+async def slow_requests(request):
+    _check_admin(request)
+
+    traces = list(slow_request_tracer.recent) if slow_request_tracer else []
+    return aiohttp.web.json_response(traces)
 
 
 @routes.route("*", "/{path:.*}")
 async def proxy_api(request):
+    timer = capture.PhaseTimer()
     path = request.match_info["path"]
+    # Filled in as the request goes along, so that requests that fail part
+    # way through are still captured and traced.
+    allowed, status, response_size = False, 500, None
+    scope = scope_timings = None
+
+    try:
+        auth_token = request.headers["Authorization"]
+
+        # strip out "Bearer " if needed
+        if auth_token.startswith("Bearer "):
+            auth_token = auth_token[len("Bearer ") :]
+
+        # Validate the magic token
+        token_info = magictoken.decode(keys, auth_token, cache=token_cache)
+        timer.mark("decode")
+
+        if token_info.scope_profile is not None:
+            allowed_scopes = scope_profiles.get(token_info.scope_profile, [])
+        else:
+            allowed_scopes = token_info.scopes
+
+        # Validate scopes againt URL and method.
+        scope_timings = [] if scope_timing else None
+        allowed, scope = scopes.check_request(
+            request.method, request.path, allowed_scopes, timings=scope_timings
+        )
+        timer.mark("scopes")
 
-    auth_token = request.headers["Authorization"]
+        if not allowed:
+            raise aiohttp.web.HTTPForbidden(
+                text=f"Disallowed by GitHub proxy. Allowed scopes: {', '.join(allowed_scopes)}"
+            )
 
-    # strip out "Bearer " if needed
-    if auth_token.startswith("Bearer "):
-        auth_token = auth_token[len("Bearer ") :]
+        path = queries.clean_path_queries(query_params_to_clean, path)
 
-    # Validate the magic token
-    token_info = magictoken.decode(keys, auth_token)
+        if downloads.is_download(request.method, path):
+            proxy = _proxy_download
+        else:
+            proxy = _proxy_request
 
-    # Validate scopes againt URL and method.
-    if not scopes.validate_request(request.method, request.path, token_info.scopes):
-        raise aiohttp.web.HTTPForbidden(
-            f"Disallowed by GitHub proxy. Allowed scopes: {', '.join(token_info.scopes)}"
+        response, response_size = await proxy(
+            request=request,
+            url=f"{GITHUB_API_ROOT}/{path}",
+            headers={"Authorization": f"Bearer {token_info.github_token}"},
+        )
+        # The body has already been relayed, so this includes streaming it.
+        timer.mark("upstream")
+
+        status = response.status
+        return response
+    except aiohttp.web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        _finish_request(
+            request, allowed, status, response_size, timer, scope, scope_timings
         )
-
-    path = queries.clean_path_queries(query_params_to_clean, path)
-
-    return await _proxy_request(
-        request=request,
-        url=f"{GITHUB_API_ROOT}/{path}",
-        headers={"Authorization": f"Bearer {token_info.github_token}"},
-    )
 
 
-async def build_app(argv):
-    global keys
+async def build_app(argv=None):
+    global keys, scope_profiles, capture_writer, http2_upstream
+    global admin_token, slow_request_tracer, scope_timing
     keys = magictoken.Keys.from_env()
+    scope_profiles = scopes.profiles_from_env()
+    capture_writer = capture.from_env()
+    http2_upstream = None
+    if os.environ.get("MAGICPROXY_UPSTREAM_HTTP2"):
+        from . import upstream
+
+        http2_upstream = upstream.from_env(asynchronous=True)
+    admin_token = os.environ.get("MAGICPROXY_ADMIN_TOKEN")
+    slow_request_tracer = profiling.tracer_from_env()
+    scope_timing = bool(os.environ.get("MAGICPROXY_SCOPE_TIMING"))
 
     app = aiohttp.web.Application()
     app.add_routes(routes)
+    if http2_upstream is not None:
+        app.on_cleanup.append(_close_http2_upstream)
     return app
 
 
+async def _close_http2_upstream(app):
+    await http2_upstream.aclose()
+
+
+def run_app():
+    aiohttp.web.run_app(build_app([]), port=int(os.environ.get("PORT", 8080)))
+
+
 if __name__ == "__main__":
-    aiohttp.web.run_app(build_app([]))
+    run_app()
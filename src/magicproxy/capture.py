@@ -0,0 +1,185 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Records redacted traffic metadata to a JSONL file for later replay.
+
+Only metadata is captured: the method, the path with all query values
+removed, header *names*, body and response sizes, the scope decision and
+per-phase timings. Tokens, header values and bodies are never written.
+
+Entries are handed to a background thread through a bounded queue, so
+recording never blocks a request. If the writer falls behind, entries are
+dropped and counted rather than queued without limit.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from typing import Iterable, Optional
+from urllib.parse import parse_qsl
+
+DEFAULT_MAX_PENDING = 10000
+
+_STOP = object()
+
+
+class PhaseTimer:
+    """Collects the duration of each phase of handling a request."""
+
+    __slots__ = ("started", "wall_started", "_last", "timings")
+
+    def __init__(self):
+        self.wall_started = time.time()
+        self.started = self._last = time.perf_counter()
+        self.timings = {}
+
+    def mark(self, phase: str):
+        """Ends the current phase, naming it ``phase``."""
+        now = time.perf_counter()
+        self.timings[phase] = now - self._last
+        self._last = now
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+
+def clean_path(path: str, query_string: str, query_params_to_clean=()) -> str:
+    """Returns the path with query values removed.
+
+    Query parameter names are kept so replayed requests hit the same kind of
+    endpoint, but their values may be sensitive and are dropped. Parameters
+    in ``query_params_to_clean`` are dropped entirely.
+    """
+    if not path.startswith("/"):
+        path = f"/{path}"
+
+    names = [
+        name
+        for name, _ in parse_qsl(query_string, keep_blank_values=True)
+        if name not in query_params_to_clean
+    ]
+    if not names:
+        return path
+    return path + "?" + "&".join(f"{name}=" for name in names)
+
+
+def entry(
+    method: str,
+    path: str,
+    header_names: Iterable[str],
+    body_size: int,
+    allowed: bool,
+    status: int,
+    response_size: Optional[int],
+    timer: PhaseTimer,
+) -> dict:
+    """Builds a capture entry. Timings are in milliseconds."""
+    timings = {phase: round(secs * 1000, 3) for phase, secs in timer.timings.items()}
+    timings["total"] = round(timer.total() * 1000, 3)
+
+    return {
+        "ts": round(timer.wall_started, 6),
+        "method": method,
+        "path": path,
+        "headers": sorted(set(name.lower() for name in header_names)),
+        "body_size": body_size,
+        "allowed": allowed,
+        "status": status,
+        "response_size": response_size,
+        "timings": timings,
+    }
+
+
+class CaptureWriter:
+    """Appends capture entries to a JSONL file from a background thread.
+
+    Args:
+        capture_file: The file to append to. ``{pid}`` is replaced with the
+            worker's process ID, so each forked worker can write its own file.
+        max_pending: How many entries may wait to be written before new ones
+            are dropped.
+    """
+
+    def __init__(self, capture_file: str, max_pending: int = DEFAULT_MAX_PENDING):
+        self.capture_file = capture_file
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pid: Optional[int] = None
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Threads don't survive a fork, so each worker starts its own writer
+        # the first time it records something.
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_pending)
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(self.capture_file.format(pid=os.getpid()), self._queue),
+                daemon=True,
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def record(self, capture_entry: dict):
+        """Queues an entry for writing without blocking."""
+        if self._pid != os.getpid():
+            self._ensure_started()
+
+        try:
+            self._queue.put_nowait(capture_entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Writes all queued entries and stops the writer thread."""
+        if self._pid != os.getpid():
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._pid = None
+
+    @staticmethod
+    def _run(capture_file, pending):
+        with open(capture_file, "a", encoding="utf-8") as fh:
+            while True:
+                batch = [pending.get()]
+                # Drain whatever else is already waiting so a busy proxy
+                # results in a few large writes rather than many small ones.
+                while True:
+                    try:
+                        batch.append(pending.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stop = _STOP in batch
+                lines = [json.dumps(item) + "\n" for item in batch if item is not _STOP]
+                fh.write("".join(lines))
+                fh.flush()
+
+                if stop:
+                    return
+
+
+def from_env() -> Optional[CaptureWriter]:
+    """Creates a writer if ``MAGICPROXY_CAPTURE_FILE`` is set."""
+    capture_file = os.environ.get("MAGICPROXY_CAPTURE_FILE")
+    if not capture_file:
+        return None
+    return CaptureWriter(capture_file)
@@ -0,0 +1,78 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for proxying archive and release asset downloads.
+
+GitHub answers these endpoints with a redirect to another host (codeload or
+a storage bucket). The proxy follows those redirects itself so clients never
+see the signed URL, and streams the body through in fixed-size chunks
+instead of buffering it, so arbitrarily large archives use bounded memory.
+Range requests are passed through untouched, so partial (206) responses
+work for resumable downloads.
+"""
+
+import re
+from typing import Tuple
+from urllib.parse import urljoin, urlparse
+
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+
+REDIRECT_STATUSES = frozenset([301, 302, 303, 307, 308])
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+_DOWNLOAD_PATHS = [
+    re.compile(r"^/?repos/[^/]+/[^/]+/(tarball|zipball)(/.*)?$"),
+    re.compile(r"^/?repos/[^/]+/[^/]+/releases/assets/\d+$"),
+]
+
+
+def is_download(method: str, path: str) -> bool:
+    """Returns True if the request should use the streaming download path."""
+    if method not in ("GET", "HEAD"):
+        return False
+    return any(pattern.match(path) for pattern in _DOWNLOAD_PATHS)
+
+
+def is_redirect(status: int, headers) -> bool:
+    return status in REDIRECT_STATUSES and "Location" in headers
+
+
+def _origin(url: str) -> Tuple[str, str, int]:
+    parts = urlparse(url)
+    scheme = parts.scheme.lower()
+    return (
+        scheme,
+        (parts.hostname or "").lower(),
+        parts.port or _DEFAULT_PORTS.get(scheme),
+    )
+
+
+def follow(url: str, headers: dict, location: str) -> Tuple[str, dict]:
+    """Returns the URL and request headers for following a redirect.
+
+    The Authorization header carries the real GitHub token, so it's only
+    kept if the redirect stays on the same scheme, host and port. In
+    particular, it's never sent after a downgrade from https to http.
+    """
+    next_url = urljoin(url, location)
+    next_headers = dict(headers)
+
+    if _origin(next_url) != _origin(url):
+        for name in list(next_headers):
+            if name.lower() == "authorization":
+                del next_headers[name]
+
+    return next_url, next_headers
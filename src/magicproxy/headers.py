@@ -14,15 +14,25 @@
 # limitations under the License.
 
 
-DEFAULT_REMOVED_REQUEST_HEADERS = set(["Host", "Connection", "Authorization"])
+# Transfer-Encoding is hop-by-hop: the body is re-framed for the upstream
+# request, so a chunked upload must not be forwarded as chunked twice.
+DEFAULT_REMOVED_REQUEST_HEADERS = set(["Host", "Connection", "Authorization",
+                                       "Transfer-Encoding"])
 
 DEFAULT_REMOVED_RESPONSE_HEADERS = set(["Content-Length",
                                     "Content-Encoding",
                                     "Transfer-Encoding"])
 
+# Downloads are relayed byte for byte, so their length and encoding still
+# describe the body the client receives.
+DOWNLOAD_REMOVED_RESPONSE_HEADERS = set(["Transfer-Encoding", "Connection"])
+
 def clean_request_headers(headers, custom_clean_headers):
     """Removes HTTP Headers for a Request
 
+    Header names are matched case-insensitively, as HTTP/2 sends them all
+    in lowercase.
+
     Args:
       headers: the HTTP headers of the request
       custom_clean_headers: a list of additional headers to remove
@@ -30,10 +40,8 @@ def clean_request_headers(headers, custom_clean_headers):
     Returns:
       HTTP headers that have been cleaned of unwanted values
     """
-    headers = dict(headers)
-    for rmv in DEFAULT_REMOVED_REQUEST_HEADERS.union(custom_clean_headers):
-        headers.pop(rmv, None)
-    return headers
+    removed = set(h.lower() for h in DEFAULT_REMOVED_REQUEST_HEADERS.union(custom_clean_headers))
+    return {k: v for k, v in dict(headers).items() if k.lower() not in removed}
 
 def clean_response_headers(headers):
     """Removes HTTP Headers for a Response
@@ -44,8 +52,26 @@ def clean_response_headers(headers):
     Returns:
       HTTP headers that have been cleaned of unwanted values
     """
-    headers = dict(headers)
-    for rmv in DEFAULT_REMOVED_RESPONSE_HEADERS:
-        headers.pop(rmv, None)
+    removed = set(h.lower() for h in DEFAULT_REMOVED_RESPONSE_HEADERS)
+    headers = {k: v for k, v in dict(headers).items() if k.lower() not in removed}
+    headers["X-Thea-Codes-GitHub-Proxy"] = "1"
+    return headers
+
+
+def clean_download_response_headers(headers):
+    """Removes HTTP Headers for a streamed download Response
+
+    Unlike clean_response_headers, this keeps Content-Length and
+    Content-Encoding along with the Range headers (Content-Range,
+    Accept-Ranges), as the body is passed through without decoding it.
+
+    Args:
+      headers: the HTTP headers of the response
+
+    Returns:
+      HTTP headers that have been cleaned of unwanted values
+    """
+    removed = set(h.lower() for h in DOWNLOAD_REMOVED_RESPONSE_HEADERS)
+    headers = {k: v for k, v in dict(headers).items() if k.lower() not in removed}
     headers["X-Thea-Codes-GitHub-Proxy"] = "1"
     return headers
@@ -16,25 +16,38 @@ import base64
 import calendar
 import datetime
 import os
-from typing import List
+from typing import cast, List, TYPE_CHECKING
 
 import attr
-from cryptography import x509
-from cryptography.hazmat import backends
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives.asymmetric import padding
-import google.auth.crypt
-import google.auth.jwt
+
+from .scopes import decode_compact, encode_compact
+
+# cryptography and google.auth are comparatively slow to import, so they're
+# only imported once a token is actually created or decoded.
+if TYPE_CHECKING:  # pragma: NO COVER
+    from cryptography import x509
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    import google.auth.crypt
 
 
 VALIDITY_PERIOD = 365 * 5  # 5 years.
 
-_BACKEND = backends.default_backend()
-_PADDING = padding.OAEP(
-    mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None
-)
+
+def _backend():
+    from cryptography.hazmat import backends
+
+    return backends.default_backend()
+
+
+def _padding():
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    return padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None,
+    )
 
 
 def _datetime_to_secs(value: datetime.datetime) -> int:
@@ -42,51 +55,76 @@ def _datetime_to_secs(value: datetime.datetime) -> int:
 
 
 def _encrypt(key, plain_text: bytes) -> bytes:
-    return key.encrypt(plain_text, _PADDING)
+    return key.encrypt(plain_text, _padding())
 
 
 def _decrypt(key, cipher_text: bytes) -> bytes:
-    return key.decrypt(
-        cipher_text,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None,
-        ),
-    )
+    return key.decrypt(cipher_text, _padding())
 
 
 @attr.s(slots=True, auto_attribs=True)
 class Keys:
-    private_key: rsa.RSAPrivateKey = None
-    private_key_signer: google.auth.crypt.RSASigner = None
-    public_key: rsa.RSAPublicKey = None
-    certificate: x509.Certificate = None
-    certificate_pem: str = None
+    """The proxy's private key and certificate.
+
+    Only the PEM bytes are read up front. Each key is parsed the first time
+    it's used, so starting the proxy doesn't pay for parsing and validating
+    key material that the first request may not even need.
+    """
+
+    private_key_pem: bytes = None
+    certificate_pem: bytes = None
+    _private_key: "rsa.RSAPrivateKey" = attr.ib(default=None, init=False, repr=False)
+    _private_key_signer: "google.auth.crypt.RSASigner" = attr.ib(
+        default=None, init=False, repr=False
+    )
+    _certificate: "x509.Certificate" = attr.ib(default=None, init=False, repr=False)
+
+    @property
+    def private_key(self) -> "rsa.RSAPrivateKey":
+        if self._private_key is None:
+            from cryptography.hazmat.primitives import serialization
+
+            # The proxy's keys are always RSA keys.
+            self._private_key = cast(
+                "rsa.RSAPrivateKey",
+                serialization.load_pem_private_key(
+                    self.private_key_pem, password=None, backend=_backend()
+                ),
+            )
+        return self._private_key
+
+    @property
+    def private_key_signer(self) -> "google.auth.crypt.RSASigner":
+        if self._private_key_signer is None:
+            import google.auth.crypt
+
+            # Reuse the parsed key rather than parsing the PEM a second time.
+            self._private_key_signer = google.auth.crypt.RSASigner(self.private_key)
+        return self._private_key_signer
+
+    @property
+    def certificate(self) -> "x509.Certificate":
+        if self._certificate is None:
+            from cryptography import x509
+
+            self._certificate = x509.load_pem_x509_certificate(
+                self.certificate_pem, _backend()
+            )
+        return self._certificate
+
+    @property
+    def public_key(self) -> "rsa.RSAPublicKey":
+        return cast("rsa.RSAPublicKey", self.certificate.public_key())
 
     @classmethod
     def from_files(cls, private_key_file, certificate_file):
         with open(private_key_file, "rb") as fh:
-            private_key_bytes = fh.read()
-            private_key = serialization.load_pem_private_key(
-                private_key_bytes, password=None, backend=_BACKEND
-            )
-            private_key_signer = google.auth.crypt.RSASigner.from_string(
-                private_key_bytes
-            )
+            private_key_pem = fh.read()
 
         with open(certificate_file, "rb") as fh:
             certificate_pem = fh.read()
-            certificate = x509.load_pem_x509_certificate(certificate_pem, _BACKEND)
-            public_key = certificate.public_key()
-
-        return cls(
-            private_key=private_key,
-            private_key_signer=private_key_signer,
-            public_key=public_key,
-            certificate=certificate,
-            certificate_pem=certificate_pem,
-        )
+
+        return cls(private_key_pem=private_key_pem, certificate_pem=certificate_pem)
 
     @classmethod
     def from_env(cls):
@@ -95,7 +133,19 @@ class Keys:
         return Keys.from_files(private_key_location, public_key_location)
 
 
-def create(keys: Keys, github_token, scopes) -> str:
+def create(keys: Keys, github_token, scopes, scope_profile=None, compact=False) -> str:
+    """Creates a magic token.
+
+    Args:
+        keys: The proxy's keys.
+        github_token: The GitHub API token to wrap.
+        scopes: The list of allowed scopes. Ignored if ``scope_profile`` is
+            given.
+        scope_profile: The ref (``id:version``) of a scope profile configured
+            on the proxy. The token then only carries the short ref.
+        compact: Whether to embed ``scopes`` with the compact encoding
+            instead of as a list of strings.
+    """
     # NOTE: This is the *public key* that we use to encrypt this token. It's
     # *extremely* important that the public key is used here, as we want only
     # our *private key* to be able to decrypt this value.
@@ -109,9 +159,17 @@ def create(keys: Keys, github_token, scopes) -> str:
         "iat": _datetime_to_secs(issued_at),
         "exp": _datetime_to_secs(expires_at),
         "github_token": encoded_github_token,
-        "scopes": scopes,
     }
 
+    if scope_profile is not None:
+        claims["scope_profile"] = scope_profile
+    elif compact:
+        claims["compact_scopes"] = encode_compact(scopes)
+    else:
+        claims["scopes"] = scopes
+
+    import google.auth.jwt
+
     jwt = google.auth.jwt.encode(keys.private_key_signer, claims)
 
     return jwt.decode("utf-8")
@@ -121,9 +179,28 @@ def create(keys: Keys, github_token, scopes) -> str:
 class DecodeResult:
     github_token: str
     scopes: List[str]
+    scope_profile: str = None
+
+
+def decode(keys, token, cache=None) -> DecodeResult:
+    """Verifies a magic token and decrypts its GitHub token.
+
+    Args:
+        keys: The proxy's keys.
+        token: The magic token.
+        cache: An optional :class:`magicproxy.tokencache.SharedTokenCache`.
+            Tokens already decoded by any worker sharing the cache are served
+            from it without repeating the signature check and decryption.
+    """
+    if cache is not None:
+        cached = cache.get(token)
+        if cached is not None:
+            return DecodeResult(
+                cached["github_token"], cached["scopes"], cached["scope_profile"]
+            )
 
+    import google.auth.jwt
 
-def decode(keys, token) -> DecodeResult:
     claims = google.auth.jwt.decode(token, verify=True, certs=[keys.certificate_pem])
 
     decoded_github_token = base64.b64decode(claims["github_token"])
@@ -132,4 +209,22 @@ def decode(keys, token) -> DecodeResult:
     )
     claims["github_token"] = decrypted_github_token
 
-    return DecodeResult(claims["github_token"], claims["scopes"])
+    if "compact_scopes" in claims:
+        claims["scopes"] = decode_compact(claims["compact_scopes"])
+
+    result = DecodeResult(
+        claims["github_token"], claims.get("scopes", []), claims.get("scope_profile")
+    )
+
+    if cache is not None:
+        cache.put(
+            token,
+            {
+                "github_token": result.github_token,
+                "scopes": result.scopes,
+                "scope_profile": result.scope_profile,
+            },
+            claims["exp"],
+        )
+
+    return result
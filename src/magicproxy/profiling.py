@@ -0,0 +1,166 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-demand profiling and slow request tracing.
+
+Nothing here runs unless it's asked for: the sampler only exists for the
+duration of an admin request, and the slow request tracer only looks at
+timings the proxies already collect for every request.
+"""
+
+import collections
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Counter, Deque, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_PROFILE_SECONDS = 60.0
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+def check_admin_token(admin_token: Optional[str], authorization: Optional[str]) -> bool:
+    """Checks an Authorization header against the configured admin token."""
+    if not admin_token or not authorization:
+        return False
+    if authorization.startswith("Bearer "):
+        authorization = authorization[len("Bearer ") :]
+    return hmac.compare_digest(
+        authorization.encode("utf-8"), admin_token.encode("utf-8")
+    )
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+class Sampler:
+    """A statistical profiler that samples the stacks of every thread.
+
+    Results are in the collapsed stack format (one ``frame;frame;frame count``
+    line per distinct stack) understood by flamegraph.pl, speedscope and
+    similar tools.
+    """
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._running = threading.Lock()
+
+    def sample(self, seconds: float) -> str:
+        """Samples all other threads for ``seconds`` and returns the stacks."""
+        if not self._running.acquire(blocking=False):
+            raise ProfilerBusy()
+
+        try:
+            stacks: Counter[str] = collections.Counter()
+            own_thread = threading.get_ident()
+            deadline = time.monotonic() + seconds
+
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(_frame_label(frame))
+                        frame = frame.f_back
+                    stacks[";".join(reversed(labels))] += 1
+                time.sleep(self.interval)
+        finally:
+            self._running.release()
+
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class SlowRequestTracer:
+    """Records per-phase timings of requests slower than a threshold.
+
+    Traces are logged as warnings and the most recent ones are kept in
+    ``recent``.
+
+    Args:
+        threshold: The request duration, in seconds, above which a request
+            is traced.
+        keep: How many recent traces to keep.
+    """
+
+    def __init__(self, threshold: float, keep: int = 100):
+        self.threshold = threshold
+        self.recent: Deque[dict] = collections.deque(maxlen=keep)
+
+    def check(
+        self,
+        method: str,
+        path: str,
+        timer,
+        scope_timings: Optional[List[Tuple[str, float]]] = None,
+        scope: Optional[str] = None,
+    ) -> Optional[dict]:
+        """Traces the request if it was slow.
+
+        Args:
+            method: The HTTP method.
+            path: The request path. This is logged, so it should already
+                have sensitive query values removed.
+            timer: The request's :class:`magicproxy.capture.PhaseTimer`.
+            scope_timings: ``(scope, seconds)`` for each evaluated scope, as
+                collected by :func:`magicproxy.scopes.validate_request`.
+            scope: The scope that allowed the request or, if it was denied,
+                the last one evaluated, as returned by
+                :func:`magicproxy.scopes.check_request`.
+
+        Returns:
+            The trace, or None if the request wasn't slow.
+        """
+        total = timer.total()
+        if total < self.threshold:
+            return None
+
+        trace = {
+            "method": method,
+            "path": path,
+            "total_ms": round(total * 1000, 3),
+            "phases_ms": {
+                phase: round(secs * 1000, 3) for phase, secs in timer.timings.items()
+            },
+            "scope": scope,
+        }
+
+        if scope_timings:
+            scope, secs = max(scope_timings, key=lambda timing: timing[1])
+            trace["slowest_scope"] = {"scope": scope, "ms": round(secs * 1000, 3)}
+
+        self.recent.append(trace)
+        logger.warning("Slow request: %s", json.dumps(trace))
+        return trace
+
+
+def tracer_from_env() -> Optional[SlowRequestTracer]:
+    """Creates a tracer if ``MAGICPROXY_SLOW_REQUEST_SECONDS`` is set."""
+    threshold = os.environ.get("MAGICPROXY_SLOW_REQUEST_SECONDS")
+    if not threshold:
+        return None
+    return SlowRequestTracer(float(threshold))
@@ -12,17 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Tuple, List
+import os
+from typing import Dict, Tuple, List
 
 import flask
 import requests
 import re
 
+from . import capture
+from . import downloads
 from . import magictoken
+from . import profiling
 from . import scopes
 from . import queries
+from . import tokencache
+from .headers import (
+    clean_download_response_headers,
+    clean_request_headers,
+    clean_response_headers,
+)
 
-GITHUB_API_ROOT = "https://api.github.com"
+GITHUB_API_ROOT = os.environ.get("MAGICPROXY_GITHUB_API_ROOT", "https://api.github.com")
 
 app = flask.Flask(__name__)
 
@@ -30,6 +40,31 @@ query_params_to_clean = set()
 
 custom_request_headers_to_clean = set()
 
+# Created on import rather than in create_app so that workers forked after
+# the module is loaded share it, see tokencache.from_env.
+token_cache = tokencache.from_env()
+
+# Scope profiles by ref, see scopes.load_profiles.
+scope_profiles: Dict[str, scopes.ScopeProfile] = {}
+
+# Records traffic metadata when set, see capture.from_env.
+capture_writer = None
+
+# Multiplexes requests to GitHub over HTTP/2 when set, see upstream.from_env.
+# The upstream module needs Python 3.7, so it's only imported when enabled.
+http2_upstream = None
+
+# The admin endpoints under /_magicproxy/ are only served when this is set.
+admin_token = None
+
+sampler = profiling.Sampler()
+
+# Traces requests above a duration when set, see profiling.tracer_from_env.
+slow_request_tracer = None
+
+# Whether to time every scope pattern evaluated for a request.
+scope_timing = False
+
 @app.route("/magictoken", methods=["POST", "GET"])
 def create_magic_token():
     params = flask.request.json
@@ -37,10 +72,23 @@ def create_magic_token():
     if not params:
         return "Request must be json.", 400
 
-    if not isinstance(params.get("scopes"), list):
+    scope_profile = params.get("scope_profile")
+
+    if scope_profile is not None:
+        if not isinstance(scope_profile, str):
+            return "scope_profile must be a string", 400
+        if scope_profile not in scope_profiles:
+            return "scope_profile is not configured on this proxy", 400
+    elif not isinstance(params.get("scopes"), list):
         return "scopes must be a list", 400
 
-    token = magictoken.create(keys, params["github_token"], params["scopes"])
+    token = magictoken.create(
+        keys,
+        params["github_token"],
+        params.get("scopes"),
+        scope_profile=scope_profile,
+        compact=bool(params.get("compact")),
+    )
 
     return token, 200, {"Content-Type": "application/jwt"}
 
@@ -48,7 +96,7 @@ def create_magic_token():
 def _proxy_request(
     request: flask.Request, url: str, headers=None, **kwargs
 ) -> Tuple[bytes, int, dict]:
-    clean_headers = headers.clean_request_headers(request.headers, custom_request_headers_to_clean)
+    clean_headers = clean_request_headers(request.headers, custom_request_headers_to_clean)
 
     if headers:
         clean_headers.update(headers)
@@ -58,52 +106,284 @@ def _proxy_request(
     )
 
     # Make the GitHub request
-    resp = requests.request(
-        url=url,
-        method=request.method,
-        headers=clean_headers,
-        params=dict(request.args),
-        data=request.data,
-        **kwargs,
-    )
+    if http2_upstream is not None:
+        from .upstream import UpstreamConnectionError
+
+        try:
+            resp = http2_upstream.request(
+                url=url,
+                method=request.method,
+                headers=clean_headers,
+                params=dict(request.args),
+                content=request.data,
+            )
+        except UpstreamConnectionError:
+            return b"Connection to GitHub failed.", 502, {}
+    else:
+        resp = requests.request(
+            url=url,
+            method=request.method,
+            headers=clean_headers,
+            params=dict(request.args),
+            data=request.data,
+            **kwargs,
+        )
 
-    response_headers = headers.clean_response_headers(resp.headers)
+    response_headers = clean_response_headers(resp.headers)
 
     print(resp, resp.headers, resp.content)
 
     return resp.content, resp.status_code, response_headers
 
 
+def _proxy_download(
+    request: flask.Request, url: str, headers=None, on_close=None
+) -> flask.Response:
+    """Relays a download, following redirects.
+
+    The body is streamed after this returns. If given, ``on_close`` is
+    called with the number of body bytes relayed when the response is
+    closed, after the request context is gone.
+    """
+    clean_headers = clean_request_headers(request.headers, custom_request_headers_to_clean)
+
+    if headers:
+        clean_headers.update(headers)
+
+    params = dict(request.args)
+
+    # Follow redirects here rather than in requests so that the GitHub token
+    # is never sent to another host.
+    for _ in range(downloads.MAX_REDIRECTS + 1):
+        resp = requests.request(
+            url=url,
+            method=request.method,
+            headers=clean_headers,
+            params=params,
+            allow_redirects=False,
+            stream=True,
+        )
+        if not downloads.is_redirect(resp.status_code, resp.headers):
+            break
+        resp.close()
+        url, clean_headers = downloads.follow(url, clean_headers, resp.headers["Location"])
+        # The redirect target carries its own query string.
+        params = None
+    else:
+        return flask.Response("Too many redirects.", status=502)
+
+    relayed = 0
+
+    def relay():
+        nonlocal relayed
+        # Relay the raw bytes, the client decodes them if needed.
+        for data in resp.raw.stream(downloads.CHUNK_SIZE, decode_content=False):
+            yield data
+            relayed += len(data)
+
+    def close():
+        resp.close()
+        if on_close is not None:
+            on_close(relayed)
+
+    response = flask.Response(
+        relay(),
+        status=resp.status_code,
+        headers=clean_download_response_headers(resp.headers),
+    )
+    # The body is never iterated for HEAD requests or clients that go away
+    # before the first chunk, so the upstream response is closed from here
+    # rather than from relay(). Callbacks aren't run for direct_passthrough
+    # responses, so it isn't used even though the body is already bytes.
+    response.call_on_close(close)
+    return response
+
+
+def _finish_request(
+    request, path, allowed, status, response_size, timer, scope, scope_timings
+):
+    # Takes the request rather than using flask.request, as downloads finish
+    # after the request context is gone.
+    if capture_writer is None and slow_request_tracer is None:
+        return
+
+    captured_path = capture.clean_path(
+        path,
+        request.query_string.decode("utf-8", "replace"),
+        query_params_to_clean,
+    )
+
+    if slow_request_tracer is not None:
+        slow_request_tracer.check(
+            request.method, captured_path, timer, scope_timings, scope
+        )
+
+    if capture_writer is not None:
+        capture_writer.record(
+            capture.entry(
+                method=request.method,
+                path=captured_path,
+                header_names=request.headers.keys(),
+                body_size=request.content_length or 0,
+                allowed=allowed,
+                status=status,
+                response_size=response_size,
+                timer=timer,
+            )
+        )
+
+
+def _admin_error():
+    """Returns an error response unless the request has the admin token."""
+    if not admin_token:
+        flask.abort(404)
+
+    if not profiling.check_admin_token(
+        admin_token, flask.request.headers.get("Authorization")
+    ):
+        return "Admin token required.", 401
+
+    return None
+
+
+@app.route("/_magicproxy/profile", methods=["GET"])
+def profile():
+    error = _admin_error()
+    if error:
+        return error
+
+    try:
+        seconds = float(flask.request.args.get("seconds", 10))
+    except ValueError:
+        return "seconds must be a number", 400
+
+    try:
+        stacks = sampler.sample(min(seconds, profiling.MAX_PROFILE_SECONDS))
+    except profiling.ProfilerBusy:
+        return "A profile is already running.", 409
+
+    return stacks, 200, {"Content-Type": "text/plain"}
+
+
+@app.route("/_magicproxy/slow-requests", methods=["GET"])
+def slow_requests():
+    error = _admin_error()
+    if error:
+        return error
+
+    traces = list(slow_request_tracer.recent) if slow_request_tracer else []
+    return flask.jsonify(traces)
+
+
 @app.route("/<path:path>", methods=["POST", "GET", "PATCH", "PUT", "DELETE"])
 def proxy_api(path):
-    auth_token = flask.request.headers["Authorization"]
-    # strip out "Bearer " if needed
-    if auth_token.startswith("Bearer "):
-        auth_token = auth_token[len("Bearer ") :]
-
-    # Validate the magic token
-    token_info = magictoken.decode(keys, auth_token)
-
-    # Validate scopes against URL and method.
-    if not scopes.validate_request(flask.request.method, path, token_info.scopes):
-        return (
-            f"Disallowed by GitHub proxy. Allowed scopes: {', '.join(token_info.scopes)}",
-            401,
+    request = flask.request._get_current_object()
+    timer = capture.PhaseTimer()
+    # Filled in as the request goes along, so that requests that fail part
+    # way through are still captured and traced.
+    allowed, status, response_size = False, 500, None
+    scope = scope_timings = None
+    # Set for downloads, which are captured and traced once their body has
+    # been relayed rather than when this returns.
+    deferred = False
+
+    try:
+        auth_token = flask.request.headers["Authorization"]
+        # strip out "Bearer " if needed
+        if auth_token.startswith("Bearer "):
+            auth_token = auth_token[len("Bearer ") :]
+
+        # Validate the magic token
+        token_info = magictoken.decode(keys, auth_token, cache=token_cache)
+        timer.mark("decode")
+
+        if token_info.scope_profile is not None:
+            allowed_scopes = scope_profiles.get(token_info.scope_profile, [])
+        else:
+            allowed_scopes = token_info.scopes
+
+        # Validate scopes against URL and method.
+        scope_timings = [] if scope_timing else None
+        allowed, scope = scopes.check_request(
+            flask.request.method, path, allowed_scopes, timings=scope_timings
         )
+        timer.mark("scopes")
 
-    path = queries.clean_path_queries(query_params_to_clean, path)
+        if not allowed:
+            status = 401
+            return (
+                f"Disallowed by GitHub proxy. Allowed scopes: {', '.join(allowed_scopes)}",
+                401,
+            )
 
-    return _proxy_request(
-        request=flask.request,
-        url=f"{GITHUB_API_ROOT}/{path}",
-        headers={"Authorization": f"Bearer {token_info.github_token}"},
-    )
+        clean_path = queries.clean_path_queries(query_params_to_clean, path)
 
+        if downloads.is_download(flask.request.method, clean_path):
 
-def run_app():
-    global keys
+            def finish_download(relayed):
+                timer.mark("upstream")
+                _finish_request(
+                    request, path, True, status, relayed, timer, scope, scope_timings
+                )
+
+            response = _proxy_download(
+                request=flask.request,
+                url=f"{GITHUB_API_ROOT}/{clean_path}",
+                headers={"Authorization": f"Bearer {token_info.github_token}"},
+                on_close=finish_download,
+            )
+
+            status = response.status_code
+            deferred = response.is_streamed
+            return response
+
+        content, status, response_headers = _proxy_request(
+            request=flask.request,
+            url=f"{GITHUB_API_ROOT}/{clean_path}",
+            headers={"Authorization": f"Bearer {token_info.github_token}"},
+        )
+        timer.mark("upstream")
+
+        response_size = len(content)
+        return content, status, response_headers
+    finally:
+        if not deferred:
+            _finish_request(
+                request,
+                path,
+                allowed,
+                status,
+                response_size,
+                timer,
+                scope,
+                scope_timings,
+            )
+
+
+def create_app():
+    """Configures the proxy from the environment and returns the WSGI app.
+
+    This is the entry point for WSGI servers, for example
+    ``gunicorn --preload 'magicproxy.proxy:create_app()'``.
+    """
+    global keys, scope_profiles, capture_writer, http2_upstream
+    global admin_token, slow_request_tracer, scope_timing
     keys = magictoken.Keys.from_env()
-    app.run()
+    scope_profiles = scopes.profiles_from_env()
+    capture_writer = capture.from_env()
+    http2_upstream = None
+    if os.environ.get("MAGICPROXY_UPSTREAM_HTTP2"):
+        from . import upstream
+
+        http2_upstream = upstream.from_env()
+    admin_token = os.environ.get("MAGICPROXY_ADMIN_TOKEN")
+    slow_request_tracer = profiling.tracer_from_env()
+    scope_timing = bool(os.environ.get("MAGICPROXY_SCOPE_TIMING"))
+    return app
+
+
+def run_app():
+    create_app().run(port=int(os.environ.get("PORT", 5000)))
 
 
 if __name__ == "__main__":
@@ -12,17 +12,178 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import json
+import os
 import re
-from typing import List
+import time
+import zlib
+from typing import Dict, List, Optional, Pattern, Tuple, Union
 
+import attr
 
-def validate_request(method: str, path: str, scopes: List[str]) -> bool:
+
+# Single byte codes for the methods used in compact scopes. Anything not in
+# this list is written out in full.
+_METHOD_CODES = ["*", "GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"]
+_CUSTOM_METHOD = 0xFF
+_COMPACT_VERSION = 1
+
+
+def _compile(scopes: List[str]) -> List[Tuple[str, Pattern]]:
+    compiled = []
+    for scope in scopes:
+        allowed_method, allowed_path = scope.split(" ", 1)
+        compiled.append((allowed_method, re.compile(allowed_path, re.I)))
+    return compiled
+
+
+@attr.s(slots=True, auto_attribs=True)
+class ScopeProfile:
+    """A named, versioned set of scopes compiled once at startup.
+
+    Tokens reference a profile by its ``ref`` (``id:version``) instead of
+    carrying the scopes themselves.
+    """
+
+    id: str
+    version: int
+    scopes: List[str]
+    compiled: List[Tuple[str, Pattern]] = attr.ib(repr=False)
+
+    @compiled.default
+    def _compile_scopes(self):
+        return _compile(self.scopes)
+
+    @property
+    def ref(self) -> str:
+        return f"{self.id}:{self.version}"
+
+    def __iter__(self):
+        return iter(self.scopes)
+
+
+def load_profiles(profiles_file) -> Dict[str, ScopeProfile]:
+    """Loads scope profiles from a JSON file.
+
+    The file must be in the format:
+
+        {
+          "profiles": [
+            {"id": "ci", "version": 1, "scopes": ["GET /user"]}
+          ]
+        }
+
+    Several versions of the same profile can be listed so that tokens minted
+    against an older version keep working.
+
+    Returns:
+        A dict mapping each profile's ref to the profile.
+    """
+    with open(profiles_file, "r", encoding="utf-8") as fh:
+        config = json.load(fh)
+
+    profiles = {}
+    for entry in config["profiles"]:
+        profile = ScopeProfile(entry["id"], int(entry["version"]), entry["scopes"])
+        if profile.ref in profiles:
+            raise ValueError(f"Duplicate scope profile {profile.ref}.")
+        profiles[profile.ref] = profile
+
+    return profiles
+
+
+def profiles_from_env() -> Dict[str, ScopeProfile]:
+    profiles_location = os.environ.get("MAGICPROXY_SCOPE_PROFILES")
+    if not profiles_location:
+        return {}
+    return load_profiles(profiles_location)
+
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_compact(scopes: List[str]) -> str:
+    """Encodes scopes into a short, URL-safe string.
+
+    Each scope is written as a method code followed by the length-prefixed
+    path pattern, and the result is deflated and base64-encoded.
+    """
+    out = bytearray([_COMPACT_VERSION])
+    for scope in scopes:
+        method, path = scope.split(" ", 1)
+        if method in _METHOD_CODES:
+            out.append(_METHOD_CODES.index(method))
+        else:
+            out.append(_CUSTOM_METHOD)
+            _write_varint(out, len(method))
+            out += method.encode("ascii")
+        encoded_path = path.encode("utf-8")
+        _write_varint(out, len(encoded_path))
+        out += encoded_path
+
+    compressed = zlib.compress(bytes(out), 9)
+    return base64.urlsafe_b64encode(compressed).rstrip(b"=").decode("ascii")
+
+
+def decode_compact(encoded: str) -> List[str]:
+    """Decodes scopes encoded with :func:`encode_compact`."""
+    padded = encoded + "=" * (-len(encoded) % 4)
+    data = zlib.decompress(base64.urlsafe_b64decode(padded))
+
+    if data[0] != _COMPACT_VERSION:
+        raise ValueError(f"Unknown compact scope version {data[0]}.")
+
+    scopes = []
+    pos = 1
+    while pos < len(data):
+        code = data[pos]
+        pos += 1
+        if code == _CUSTOM_METHOD:
+            length, pos = _read_varint(data, pos)
+            method = data[pos : pos + length].decode("ascii")
+            pos += length
+        else:
+            method = _METHOD_CODES[code]
+        length, pos = _read_varint(data, pos)
+        path = data[pos : pos + length].decode("utf-8")
+        pos += length
+        scopes.append(f"{method} {path}")
+
+    return scopes
+
+
+def validate_request(
+    method: str,
+    path: str,
+    scopes: Union[List[str], ScopeProfile],
+    timings: Optional[List[Tuple[str, float]]] = None,
+) -> bool:
     """Basic scope validation routine.
 
     Args:
         method: The HTTP method.
         path: The request path.
-        scopes: The list of allowed scopes.
+        scopes: The list of allowed scopes, or a precompiled
+            :class:`ScopeProfile`.
+        timings: If given, ``(scope, seconds)`` is appended to it for each
+            scope whose pattern is evaluated. Useful for finding patterns
+            that backtrack badly.
 
     The scope must be in the format:
 
@@ -35,18 +196,47 @@ def validate_request(method: str, path: str, scopes: List[str]) -> bool:
 
     Would allow getting the user info and updating labels on issues.
     """
-    validated = False
-    for scope in scopes:
-        allowed_method, allowed_path = scope.split(" ", 1)
+    allowed, _ = check_request(method, path, scopes, timings=timings)
+    return allowed
+
+
+def check_request(
+    method: str,
+    path: str,
+    scopes: Union[List[str], ScopeProfile],
+    timings: Optional[List[Tuple[str, float]]] = None,
+) -> Tuple[bool, Optional[str]]:
+    """Like :func:`validate_request`, but also returns the deciding scope.
+
+    Returns:
+        Whether the request is allowed, and either the scope that allowed it
+        or, for a denied request, the last scope whose pattern was evaluated
+        (None if there wasn't one).
+    """
+    if not path.startswith("/"):
+        path = f"/{path}"
+
+    if isinstance(scopes, ScopeProfile):
+        compiled = scopes.compiled
+    else:
+        # re caches compiled patterns, so this is cheap for repeat tokens.
+        compiled = _compile(scopes)
+
+    evaluated = None
 
+    for scope, (allowed_method, allowed_pattern) in zip(scopes, compiled):
         if method != allowed_method and allowed_method != "*":
             continue
 
-        if not path.startswith("/"):
-            path = f"/{path}"
+        evaluated = scope
+        if timings is None:
+            matched = allowed_pattern.match(path)
+        else:
+            started = time.perf_counter()
+            matched = allowed_pattern.match(path)
+            timings.append((scope, time.perf_counter() - started))
 
-        if re.match(allowed_path, path, re.I):
-            validated = True
-            break
+        if matched:
+            return True, scope
 
-    return validated
+    return False, evaluated
@@ -0,0 +1,229 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A cross-worker cache of decoded magic tokens.
+
+Decoding a magic token means verifying the JWT signature and RSA-decrypting
+the GitHub token, which is by far the most expensive part of handling a
+request. When the proxy runs as several forked workers each worker would
+otherwise repeat that work for the same tokens, so this cache keeps decoded
+results in an anonymous shared memory mapping that every worker can read.
+
+The table is a fixed number of fixed-size slots. A token's slot is chosen
+from its SHA-256 digest and lookups probe a small window of neighbouring
+slots. Each slot is guarded by a sequence counter: writers bump it to an odd
+value before writing and to an even value afterwards, and anything a reader
+copies while the counter was odd or changed underneath it is discarded as a
+miss, so readers never take a lock. Writers serialize on a single
+process-shared lock, which is fine as writes only happen on cache misses. A
+writer that can't get the lock quickly skips the write instead of waiting,
+so a worker that dies while holding it can't stall the others.
+
+When a probe window is full, a victim is picked with the clock algorithm:
+a hit sets a slot's reference bit, and the eviction hand clears reference
+bits until it finds a slot without one.
+
+The decoded GitHub token and scopes are never stored in the clear. They are
+sealed with AES-GCM under a key that is generated when the cache is created
+and only ever lives in process memory, so the shared mapping is useless
+without it. The cache must be created *before* the workers are forked so that
+every worker shares both the mapping and the key. The proxies create it when
+their module is imported, so the server has to import the app before forking
+(for example, gunicorn's ``--preload``).
+"""
+
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+from typing import Optional
+
+DEFAULT_SLOTS = 1024
+DEFAULT_SLOT_SIZE = 4096
+PROBE_WINDOW = 8
+# How long a write waits for the lock before giving up, in seconds.
+LOCK_TIMEOUT = 0.1
+
+# seq, digest, expiry, reference bit, payload length, nonce.
+_SLOT_HEADER = struct.Struct("<I32sqBH12s")
+# The clock hand lives at the start of the mapping, before the slots.
+_TABLE_HEADER = struct.Struct("<Q")
+_SEQ = struct.Struct("<I")
+_REF_OFFSET = 4 + 32 + 8
+
+
+def _associated_data(digest: bytes, expiry: int) -> bytes:
+    # Binding the digest and expiry to the ciphertext means a torn read of the
+    # slot header can never pair a payload with the wrong token or lifetime.
+    return digest + struct.pack("<q", expiry)
+
+
+class SharedTokenCache:
+    """A fixed-size, shared memory hash table of decoded magic tokens.
+
+    Args:
+        slots: The number of slots in the table.
+        slot_size: The size of each slot in bytes. Decoded tokens that do not
+            fit (for example, tokens with very large scope lists) are simply
+            not cached.
+    """
+
+    def __init__(self, slots: int = DEFAULT_SLOTS, slot_size: int = DEFAULT_SLOT_SIZE):
+        if slots < PROBE_WINDOW:
+            raise ValueError(f"A token cache needs at least {PROBE_WINDOW} slots.")
+        if slot_size <= _SLOT_HEADER.size:
+            raise ValueError(
+                f"Slot size must be larger than {_SLOT_HEADER.size} bytes."
+            )
+
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        self.slots = slots
+        self.slot_size = slot_size
+        self._max_payload = slot_size - _SLOT_HEADER.size
+        # An anonymous MAP_SHARED mapping is inherited by forked children and
+        # writes from any of them are visible to all of them.
+        self._mmap = mmap.mmap(-1, _TABLE_HEADER.size + slots * slot_size)
+        self._lock = multiprocessing.Lock()
+        self._aead = AESGCM(AESGCM.generate_key(bit_length=128))
+
+    def _slot_offset(self, index: int) -> int:
+        return _TABLE_HEADER.size + index * self.slot_size
+
+    def _window(self, digest: bytes):
+        start = int.from_bytes(digest[:8], "little") % self.slots
+        return [(start + i) % self.slots for i in range(PROBE_WINDOW)]
+
+    def get(self, token: str) -> Optional[dict]:
+        """Returns the cached payload for a token, or None on a miss."""
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        now = int(time.time())
+
+        for index in self._window(digest):
+            offset = self._slot_offset(index)
+            seq, slot_digest, expiry, _, length, nonce = _SLOT_HEADER.unpack_from(
+                self._mmap, offset
+            )
+            if seq & 1 or slot_digest != digest:
+                continue
+            if expiry <= now or length > self._max_payload:
+                return None
+
+            start = offset + _SLOT_HEADER.size
+            sealed = self._mmap[start : start + length]
+
+            # If a writer touched the slot while we were copying it, treat
+            # it as a miss rather than waiting for the writer.
+            if _SEQ.unpack_from(self._mmap, offset)[0] != seq:
+                return None
+
+            try:
+                plain = self._aead.decrypt(
+                    nonce, sealed, _associated_data(digest, expiry)
+                )
+            except Exception:
+                return None
+
+            self._mmap[offset + _REF_OFFSET] = 1
+            return json.loads(plain.decode("utf-8"))
+
+        return None
+
+    def put(self, token: str, payload: dict, expiry: int) -> bool:
+        """Stores the payload for a token until the given UNIX expiry time.
+
+        Returns:
+            True if the payload was stored, False if it was too large or
+            the write lock couldn't be taken in time.
+        """
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        nonce = os.urandom(12)
+        sealed = self._aead.encrypt(
+            nonce, json.dumps(payload).encode("utf-8"), _associated_data(digest, expiry)
+        )
+        if len(sealed) > self._max_payload:
+            return False
+
+        if not self._lock.acquire(timeout=LOCK_TIMEOUT):
+            return False
+
+        try:
+            index = self._find_victim(digest)
+            offset = self._slot_offset(index)
+            seq = _SEQ.unpack_from(self._mmap, offset)[0]
+
+            _SEQ.pack_into(self._mmap, offset, (seq + 1) & 0xFFFFFFFF)
+            _SLOT_HEADER.pack_into(
+                self._mmap,
+                offset,
+                (seq + 1) & 0xFFFFFFFF,
+                digest,
+                expiry,
+                0,
+                len(sealed),
+                nonce,
+            )
+            start = offset + _SLOT_HEADER.size
+            self._mmap[start : start + len(sealed)] = sealed
+            _SEQ.pack_into(self._mmap, offset, (seq + 2) & 0xFFFFFFFF)
+        finally:
+            self._lock.release()
+
+        return True
+
+    def _find_victim(self, digest: bytes) -> int:
+        """Picks the slot to write a digest into. Must hold the write lock."""
+        window = self._window(digest)
+        now = int(time.time())
+
+        headers = [
+            _SLOT_HEADER.unpack_from(self._mmap, self._slot_offset(index))
+            for index in window
+        ]
+
+        # Overwrite the token's own slot if it has one anywhere in the window,
+        # otherwise the window would end up holding it twice.
+        for index, (_, slot_digest, _, _, _, _) in zip(window, headers):
+            if slot_digest == digest:
+                return index
+
+        for index, (_, _, expiry, _, _, _) in zip(window, headers):
+            if expiry <= now:
+                return index
+
+        hand = _TABLE_HEADER.unpack_from(self._mmap, 0)[0]
+        # Two sweeps are always enough: the first clears every reference
+        # bit it passes, so the second is guaranteed to find a victim.
+        for step in range(2 * PROBE_WINDOW):
+            index = window[(hand + step) % PROBE_WINDOW]
+            ref_offset = self._slot_offset(index) + _REF_OFFSET
+            if self._mmap[ref_offset]:
+                self._mmap[ref_offset] = 0
+                continue
+            _TABLE_HEADER.pack_into(self._mmap, 0, hand + step + 1)
+            return index
+
+        return window[hand % PROBE_WINDOW]
+
+
+def from_env() -> Optional[SharedTokenCache]:
+    """Creates a cache if ``MAGICPROXY_TOKEN_CACHE_SLOTS`` is set."""
+    slots = os.environ.get("MAGICPROXY_TOKEN_CACHE_SLOTS")
+    if not slots:
+        return None
+    slot_size = os.environ.get("MAGICPROXY_TOKEN_CACHE_SLOT_SIZE", DEFAULT_SLOT_SIZE)
+    return SharedTokenCache(slots=int(slots), slot_size=int(slot_size))
@@ -0,0 +1,280 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An optional HTTP/2 transport for requests to GitHub.
+
+Instead of opening a connection per in-flight request, proxied requests are
+multiplexed as streams over a small, fixed number of long-lived HTTP/2
+connections. Each connection carries at most ``streams_per_connection``
+concurrent streams; once every connection is full, further requests wait for
+a free stream rather than opening more connections.
+
+If the server doesn't negotiate HTTP/2, the transport falls back to a
+regular pooled HTTP/1.1 client for the rest of the process. If an HTTP/2
+connection breaks before a response arrives, idempotent requests are retried
+on a fresh connection and other requests fail with
+:class:`UpstreamConnectionError`.
+
+This needs ``httpx[http2]``, which is installed with the ``http2`` extra.
+"""
+
+import asyncio
+import contextlib
+import os
+import threading
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_STREAMS_PER_CONNECTION = 100
+DEFAULT_TIMEOUT = 60.0
+PROTOCOL_ERROR_RETRIES = 1
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+# Connection-specific headers aren't allowed in HTTP/2, and the client sets
+# the length itself.
+_REMOVED_REQUEST_HEADERS = frozenset(
+    [
+        "connection",
+        "content-length",
+        "host",
+        "keep-alive",
+        "proxy-connection",
+        "te",
+        "transfer-encoding",
+        "upgrade",
+    ]
+)
+
+
+class UpstreamConnectionError(Exception):
+    """Raised when an HTTP/2 connection breaks before a response arrives and
+    the request can't be retried."""
+
+
+def _clean_headers(headers) -> dict:
+    return {
+        name: value
+        for name, value in headers.items()
+        if name.lower() not in _REMOVED_REQUEST_HEADERS
+    }
+
+
+class _Http2Pool:
+    def __init__(self, connections, streams_per_connection, prior_knowledge, timeout):
+        try:
+            import httpx
+        except ImportError as exc:
+            raise RuntimeError(
+                "The HTTP/2 upstream needs httpx[http2], install magicproxy[http2]."
+            ) from exc
+
+        self._httpx = httpx
+        self._connection_errors = (httpx.RemoteProtocolError, httpx.NetworkError)
+        self.connections = connections
+        self.streams_per_connection = streams_per_connection
+        self.prior_knowledge = prior_knowledge
+        self.timeout = timeout
+        # Set to False once the upstream turns out not to speak HTTP/2.
+        self.http2 = True
+        self._in_flight = [0] * connections
+        self._in_flight_lock = threading.Lock()
+
+    def _client_args(self, http2: bool) -> dict:
+        httpx = self._httpx
+        if http2:
+            # One connection per client, so each client is one multiplexed
+            # connection and the pool decides which one a request uses.
+            limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+            return dict(
+                http1=not self.prior_knowledge,
+                http2=True,
+                limits=limits,
+                timeout=self.timeout,
+            )
+
+        max_connections = self.connections * self.streams_per_connection
+        limits = httpx.Limits(max_connections=max_connections)
+        return dict(limits=limits, timeout=self.timeout)
+
+    def _checkout(self) -> int:
+        """Picks the connection with the fewest in-flight streams."""
+        with self._in_flight_lock:
+            index = min(range(self.connections), key=self._in_flight.__getitem__)
+            self._in_flight[index] += 1
+            return index
+
+    def _checkin(self, index: int):
+        with self._in_flight_lock:
+            self._in_flight[index] -= 1
+
+    def _check_version(self, response):
+        if response.http_version != "HTTP/2":
+            self.http2 = False
+
+    def _should_retry(self, method: str, attempt: int) -> bool:
+        # A failed connection is dropped from its client's pool, so a retry
+        # opens a fresh one.
+        return method in IDEMPOTENT_METHODS and attempt < PROTOCOL_ERROR_RETRIES
+
+
+class Http2Upstream(_Http2Pool):
+    """A thread-safe HTTP/2 upstream for the Flask app.
+
+    Args:
+        connections: The number of HTTP/2 connections to keep open.
+        streams_per_connection: The most concurrent requests on a connection.
+        prior_knowledge: Speak HTTP/2 without negotiating it first. This
+            disables the HTTP/1.1 fallback and is mostly useful for talking
+            to plaintext (h2c) servers in tests.
+        timeout: The timeout for each request, in seconds.
+    """
+
+    def __init__(
+        self,
+        connections: int = DEFAULT_CONNECTIONS,
+        streams_per_connection: int = DEFAULT_STREAMS_PER_CONNECTION,
+        prior_knowledge: bool = False,
+        timeout: float = DEFAULT_TIMEOUT,
+    ):
+        super().__init__(connections, streams_per_connection, prior_knowledge, timeout)
+        httpx = self._httpx
+        self._clients = [
+            httpx.Client(**self._client_args(http2=True)) for _ in range(connections)
+        ]
+        self._http1_client = httpx.Client(**self._client_args(http2=False))
+        self._streams = threading.BoundedSemaphore(connections * streams_per_connection)
+
+    def request(self, method, url, headers, params=None, content=None):
+        """Sends a request and returns the fully read ``httpx.Response``."""
+        headers = _clean_headers(headers)
+
+        if self.http2:
+            with self._streams:
+                for attempt in range(PROTOCOL_ERROR_RETRIES + 1):
+                    index = self._checkout()
+                    try:
+                        response = self._clients[index].request(
+                            method,
+                            url,
+                            headers=headers,
+                            params=params,
+                            content=content,
+                        )
+                        self._check_version(response)
+                        return response
+                    except self._connection_errors as exc:
+                        if not self._should_retry(method, attempt):
+                            raise UpstreamConnectionError(str(exc)) from exc
+                    finally:
+                        self._checkin(index)
+
+        return self._http1_client.request(
+            method, url, headers=headers, params=params, content=content
+        )
+
+    def close(self):
+        for client in self._clients:
+            client.close()
+        self._http1_client.close()
+
+
+class AsyncHttp2Upstream(_Http2Pool):
+    """An HTTP/2 upstream for the aiohttp app.
+
+    Takes the same arguments as :class:`Http2Upstream`.
+    """
+
+    def __init__(
+        self,
+        connections: int = DEFAULT_CONNECTIONS,
+        streams_per_connection: int = DEFAULT_STREAMS_PER_CONNECTION,
+        prior_knowledge: bool = False,
+        timeout: float = DEFAULT_TIMEOUT,
+    ):
+        super().__init__(connections, streams_per_connection, prior_knowledge, timeout)
+        httpx = self._httpx
+        self._clients = [
+            httpx.AsyncClient(**self._client_args(http2=True))
+            for _ in range(connections)
+        ]
+        self._http1_client = httpx.AsyncClient(**self._client_args(http2=False))
+        # Created on first use so that it belongs to the running loop.
+        self._streams = None
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, headers, params=None, content=None):
+        """Sends a request and yields the ``httpx.Response`` to stream from."""
+        headers = _clean_headers(headers)
+
+        if self.http2:
+            if self._streams is None:
+                self._streams = asyncio.BoundedSemaphore(
+                    self.connections * self.streams_per_connection
+                )
+
+            async with self._streams:
+                for attempt in range(PROTOCOL_ERROR_RETRIES + 1):
+                    index = self._checkout()
+                    started = False
+                    try:
+                        proxied_request = self._clients[index].stream(
+                            method,
+                            url,
+                            headers=headers,
+                            params=params,
+                            content=content,
+                        )
+                        async with proxied_request as response:
+                            self._check_version(response)
+                            started = True
+                            yield response
+                        return
+                    except self._connection_errors as exc:
+                        # Once the response has been handed out it's too late
+                        # to retry.
+                        if started:
+                            raise
+                        if not self._should_retry(method, attempt):
+                            raise UpstreamConnectionError(str(exc)) from exc
+                    finally:
+                        self._checkin(index)
+
+        proxied_request = self._http1_client.stream(
+            method, url, headers=headers, params=params, content=content
+        )
+        async with proxied_request as response:
+            yield response
+
+    async def aclose(self):
+        for client in self._clients:
+            await client.aclose()
+        await self._http1_client.aclose()
+
+
+def from_env(asynchronous: bool = False):
+    """Creates an upstream if ``MAGICPROXY_UPSTREAM_HTTP2`` is set."""
+    if os.environ.get("MAGICPROXY_UPSTREAM_HTTP2", "").lower() not in ("1", "true"):
+        return None
+
+    upstream_class = AsyncHttp2Upstream if asynchronous else Http2Upstream
+    return upstream_class(
+        connections=int(
+            os.environ.get("MAGICPROXY_UPSTREAM_HTTP2_CONNECTIONS", DEFAULT_CONNECTIONS)
+        ),
+        streams_per_connection=int(
+            os.environ.get(
+                "MAGICPROXY_UPSTREAM_HTTP2_STREAMS", DEFAULT_STREAMS_PER_CONNECTION
+            )
+        ),
+    )
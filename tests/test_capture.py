@@ -0,0 +1,237 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import http.server
+import importlib
+import json
+import os
+import queue
+import threading
+
+import pytest
+
+from magicproxy import capture
+from magicproxy import magictoken
+
+
+def test_clean_path_removes_query_values():
+    actual = capture.clean_path("repos/a/b/issues", "state=open&page=2")
+    assert actual == "/repos/a/b/issues?state=&page="
+
+
+def test_clean_path_drops_cleaned_params():
+    actual = capture.clean_path("/user", "key=secret&page=2", {"key"})
+    assert actual == "/user?page="
+
+
+def test_clean_path_without_query():
+    assert capture.clean_path("/user", "") == "/user"
+
+
+def test_entry_is_redacted():
+    timer = capture.PhaseTimer()
+    timer.mark("decode")
+    timer.mark("scopes")
+
+    actual = capture.entry(
+        method="GET",
+        path="/user",
+        header_names=["Authorization", "Accept", "accept"],
+        body_size=0,
+        allowed=True,
+        status=200,
+        response_size=12,
+        timer=timer,
+    )
+
+    assert actual["headers"] == ["accept", "authorization"]
+    assert sorted(actual["timings"]) == ["decode", "scopes", "total"]
+    assert actual["timings"]["total"] >= actual["timings"]["decode"]
+    # Entries must be serializable as they are.
+    json.dumps(actual)
+
+
+def test_writer_appends_jsonl(tmpdir):
+    capture_file = tmpdir.join("capture.jsonl")
+    writer = capture.CaptureWriter(str(capture_file))
+
+    for n in range(10):
+        writer.record({"n": n})
+    writer.close()
+
+    lines = capture_file.read().splitlines()
+    assert [json.loads(line) for line in lines] == [{"n": n} for n in range(10)]
+
+
+def test_writer_drops_instead_of_blocking(tmpdir):
+    writer = capture.CaptureWriter(str(tmpdir.join("capture.jsonl")), max_pending=1)
+    # Pretend the writer thread is running but stuck.
+    writer._pid = os.getpid()
+    writer._queue = queue.Queue(maxsize=1)
+
+    for n in range(5):
+        writer.record({"n": n})
+
+    assert writer.dropped == 4
+
+
+def test_writer_restarts_after_fork(tmpdir):
+    capture_file = tmpdir.join("capture-{pid}.jsonl")
+    writer = capture.CaptureWriter(str(capture_file))
+    writer.record({"from": "parent"})
+
+    pid = os.fork()
+    if pid == 0:
+        writer.record({"from": "child"})
+        writer.close()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    writer.close()
+
+    child_file = tmpdir.join(f"capture-{pid}.jsonl")
+    assert json.loads(child_file.read()) == {"from": "child"}
+    parent_file = tmpdir.join(f"capture-{os.getpid()}.jsonl")
+    assert json.loads(parent_file.read()) == {"from": "parent"}
+
+
+class _UpstreamHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding") != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b""
+        while True:
+            size = int(self.rfile.readline(), 16)
+            body += self.rfile.read(size)
+            self.rfile.readline()
+            if not size:
+                return body
+
+    def do_POST(self):
+        self._read_body()
+        self.send_response(201)
+        self.send_header("Content-Length", "9")
+        self.end_headers()
+        self.wfile.write(b'{"id": 1}')
+
+    def do_GET(self):
+        # Drop the connection without a response.
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+KEYS = magictoken.Keys.from_files(
+    private_key_file=os.path.join(os.path.dirname(__file__), "data", "private.pem"),
+    certificate_file=os.path.join(os.path.dirname(__file__), "data", "public.x509.cer"),
+)
+TOKEN = magictoken.create(KEYS, "github token", ["POST /user/repos", "GET /broken"])
+AUTHORIZATION = {"Authorization": f"Bearer {TOKEN}"}
+
+# An allowed request, a denied one and one whose upstream connection fails.
+APP_REQUESTS = [
+    ("POST", "/user/repos?visibility=private", b'{"name": "x"}'),
+    ("GET", "/orgs/a", b""),
+    ("GET", "/broken", b""),
+]
+
+
+def _send_flask(module):
+    client = module.app.test_client()
+    return [
+        client.open(path, method=method, headers=AUTHORIZATION, data=body).status_code
+        for method, path, body in APP_REQUESTS
+    ]
+
+
+def _send_aiohttp(module):
+    import aiohttp.test_utils
+    import aiohttp.web
+
+    async def chunked(body):
+        yield body
+
+    async def main():
+        app = aiohttp.web.Application()
+        app.add_routes(module.routes)
+        async with aiohttp.test_utils.TestClient(
+            aiohttp.test_utils.TestServer(app)
+        ) as client:
+            statuses = []
+            for method, path, body in APP_REQUESTS:
+                response = await client.request(
+                    method,
+                    path,
+                    headers=AUTHORIZATION,
+                    data=chunked(body) if body else None,
+                )
+                statuses.append(response.status)
+            return statuses
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize(
+    "server, send, denied_status",
+    [("proxy", _send_flask, 401), ("async_proxy", _send_aiohttp, 403)],
+)
+def test_apps_capture_each_request(monkeypatch, tmpdir, server, send, denied_status):
+    module = importlib.import_module(f"magicproxy.{server}")
+    upstream = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _UpstreamHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+
+    capture_file = tmpdir.join("capture.jsonl")
+    monkeypatch.setenv("MAGICPROXY_CAPTURE_FILE", str(capture_file))
+    writer = capture.from_env()
+    monkeypatch.setattr(module, "capture_writer", writer)
+    monkeypatch.setattr(module, "keys", KEYS, raising=False)
+    monkeypatch.setattr(
+        module, "GITHUB_API_ROOT", f"http://127.0.0.1:{upstream.server_port}"
+    )
+
+    try:
+        statuses = send(module)
+    finally:
+        upstream.shutdown()
+    writer.close()
+
+    assert statuses == [201, denied_status, 500]
+    captured = capture_file.read()
+    assert TOKEN not in captured
+    assert "github token" not in captured
+    assert "private" not in captured
+
+    allowed, denied, failed = [json.loads(line) for line in captured.splitlines()]
+    assert allowed["method"] == "POST"
+    assert allowed["path"] == "/user/repos?visibility="
+    assert "authorization" in allowed["headers"]
+    assert allowed["body_size"] == len(APP_REQUESTS[0][2])
+    assert (allowed["allowed"], allowed["status"], allowed["response_size"]) == (
+        True,
+        201,
+        9,
+    )
+    assert (denied["allowed"], denied["status"], denied["response_size"]) == (
+        False,
+        denied_status,
+        None,
+    )
+    assert (failed["allowed"], failed["status"], failed["response_size"]) == (
+        True,
+        500,
+        None,
+    )
@@ -37,3 +37,25 @@ def test_leaves_headers_alone_if_undefined():
     hdrs['X-Custom-Me'] = 'A Custom Value'
     actual = headers.clean_request_headers(hdrs, request_headers_to_clean)
     assert hdrs == actual
+
+def test_clean_download_response_headers_keeps_length_and_range():
+    hdrs = {
+        'Content-Length': '100',
+        'Content-Encoding': 'gzip',
+        'Content-Range': 'bytes 0-99/1000',
+        'Transfer-Encoding': 'chunked',
+    }
+    actual = headers.clean_download_response_headers(hdrs)
+    assert actual['Content-Length'] == '100'
+    assert actual['Content-Encoding'] == 'gzip'
+    assert actual['Content-Range'] == 'bytes 0-99/1000'
+    assert 'Transfer-Encoding' not in actual
+
+def test_clean_headers_ignores_case():
+    hdrs = {'authorization': 'secret', 'x-custom-me': 'A Custom Value', 'Accept': '*/*'}
+    actual = headers.clean_request_headers(hdrs, ['X-Custom-Me'])
+    assert actual == {'Accept': '*/*'}
+
+    actual = headers.clean_response_headers(
+        {'content-length': '10', 'content-encoding': 'gzip'})
+    assert actual == {'X-Thea-Codes-GitHub-Proxy': '1'}
@@ -0,0 +1,295 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import gzip
+import http.server
+import os
+import threading
+
+import pytest
+
+from magicproxy import downloads
+from magicproxy import magictoken
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+KEYS = magictoken.Keys.from_files(
+    private_key_file=os.path.join(DATA, "private.pem"),
+    certificate_file=os.path.join(DATA, "public.x509.cer"),
+)
+ARCHIVE = gzip.compress(bytes(range(256)) * 1024)
+
+
+def test_is_download():
+    assert downloads.is_download("GET", "repos/theacodes/nox/tarball")
+    assert downloads.is_download("GET", "/repos/theacodes/nox/zipball/master")
+    assert downloads.is_download("HEAD", "/repos/theacodes/nox/releases/assets/123")
+
+
+def test_is_not_download():
+    assert not downloads.is_download("GET", "/repos/theacodes/nox/issues")
+    assert not downloads.is_download("GET", "/repos/theacodes/nox/releases/assets")
+    assert not downloads.is_download("POST", "/repos/theacodes/nox/tarball")
+
+
+def test_is_redirect():
+    assert downloads.is_redirect(302, {"Location": "https://codeload.github.com/"})
+    assert not downloads.is_redirect(302, {})
+    assert not downloads.is_redirect(200, {"Location": "https://codeload.github.com/"})
+
+
+def test_follow_strips_authorization_off_host():
+    headers = {"Authorization": "Bearer secret", "Range": "bytes=100-"}
+    url, actual = downloads.follow(
+        "https://api.github.com/repos/a/b/tarball",
+        headers,
+        "https://codeload.github.com/a/b/legacy.tar.gz/master?token=x",
+    )
+
+    assert url == "https://codeload.github.com/a/b/legacy.tar.gz/master?token=x"
+    assert actual == {"Range": "bytes=100-"}
+    # The original headers are left alone.
+    assert "Authorization" in headers
+
+
+def test_follow_keeps_authorization_on_same_host():
+    headers = {"authorization": "Bearer secret"}
+    url, actual = downloads.follow(
+        "https://api.github.com/repos/a/b/tarball", headers, "/repositories/1/tarball"
+    )
+
+    assert url == "https://api.github.com/repositories/1/tarball"
+    assert actual == headers
+
+
+def test_follow_strips_authorization_on_downgrade():
+    headers = {"Authorization": "Bearer secret"}
+    _, actual = downloads.follow(
+        "https://api.github.com/repos/a/b/tarball",
+        headers,
+        "http://api.github.com/repos/a/b/tarball",
+    )
+
+    assert actual == {}
+
+
+def test_follow_strips_authorization_on_port_change():
+    headers = {"Authorization": "Bearer secret"}
+    _, actual = downloads.follow(
+        "https://api.github.com/repos/a/b/tarball",
+        headers,
+        "https://api.github.com:8443/repos/a/b/tarball",
+    )
+
+    assert actual == {}
+
+
+def test_follow_treats_default_port_as_same_origin():
+    headers = {"Authorization": "Bearer secret"}
+    _, actual = downloads.follow(
+        "https://api.github.com/repos/a/b/tarball",
+        headers,
+        "https://API.github.com:443/repositories/1/tarball",
+    )
+
+    assert actual == headers
+
+
+class TwoHostStandIn:
+    """Serves the API as 127.0.0.1 and redirects archives to localhost.
+
+    Both names reach the same server, but they're different hosts as far
+    as the proxy is concerned.
+    """
+
+    def __init__(self):
+        self.requests = []
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                self.do_GET(send_body=False)
+
+            def do_GET(self, send_body=True):
+                standin.requests.append(
+                    (self.headers["Host"], self.path, self.headers["Authorization"])
+                )
+
+                if self.path.startswith("/repos/"):
+                    self.send_response(302)
+                    self.send_header("Location", f"{standin.asset_root}/archive?sig=1")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                body = ARCHIVE
+                if self.headers["Range"]:
+                    start = int(self.headers["Range"][len("bytes=") :].rstrip("-"))
+                    body = ARCHIVE[start:]
+                    self.send_response(206)
+                    self.send_header(
+                        "Content-Range",
+                        f"bytes {start}-{len(ARCHIVE) - 1}/{len(ARCHIVE)}",
+                    )
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/x-tar")
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api_root = f"http://127.0.0.1:{self.server.server_port}"
+        self.asset_root = f"http://localhost:{self.server.server_port}"
+
+
+@pytest.fixture
+def standin():
+    server = TwoHostStandIn()
+    yield server
+    server.server.shutdown()
+
+
+def _fetch_flask(method, path, headers):
+    from magicproxy import proxy
+
+    response = proxy.app.test_client().open(path, method=method, headers=headers)
+    return response.status_code, response.headers, response.data
+
+
+def _fetch_aiohttp(method, path, headers):
+    import aiohttp.test_utils
+    import aiohttp.web
+
+    from magicproxy import async_proxy
+
+    async def fetch():
+        app = aiohttp.web.Application()
+        app.add_routes(async_proxy.routes)
+        server = aiohttp.test_utils.TestServer(app)
+        # Check the body exactly as it was relayed.
+        async with aiohttp.test_utils.TestClient(
+            server, auto_decompress=False
+        ) as client:
+            response = await client.request(method, path, headers=headers)
+            return response.status, response.headers, await response.read()
+
+    return asyncio.run(fetch())
+
+
+@pytest.fixture(params=["proxy", "async_proxy"])
+def fetch(request, monkeypatch, standin):
+    """Configures one of the apps against the stand-in and returns a function
+    that sends a request through it with a magic token."""
+    if request.param == "proxy":
+        from magicproxy import proxy as module
+
+        fetch_from_app = _fetch_flask
+    else:
+        from magicproxy import async_proxy as module
+
+        fetch_from_app = _fetch_aiohttp
+
+    monkeypatch.setattr(module, "keys", KEYS, raising=False)
+    monkeypatch.setattr(module, "GITHUB_API_ROOT", standin.api_root)
+    token = magictoken.create(
+        KEYS, "github token", ["GET /repos/a/b/.*", "HEAD /repos/a/b/.*"]
+    )
+
+    def fetch(path, method="GET", headers=None):
+        headers = dict(headers or {}, Authorization=f"Bearer {token}")
+        return fetch_from_app(method, path, headers)
+
+    return fetch
+
+
+def test_download_follows_redirect_without_github_token(fetch, standin):
+    status, headers, body = fetch("/repos/a/b/tarball/main")
+
+    assert status == 200
+    assert body == ARCHIVE
+    api_host = standin.api_root[len("http://") :]
+    asset_host = standin.asset_root[len("http://") :]
+    assert standin.requests == [
+        (api_host, "/repos/a/b/tarball/main", "Bearer github token"),
+        (asset_host, "/archive?sig=1", None),
+    ]
+
+
+def test_download_keeps_length_and_encoding(fetch):
+    status, headers, body = fetch("/repos/a/b/tarball/main")
+
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Content-Length"] == str(len(ARCHIVE))
+    assert len(body) == len(ARCHIVE)
+
+
+def test_download_range(fetch):
+    status, headers, body = fetch(
+        "/repos/a/b/tarball/main", headers={"Range": "bytes=1000-"}
+    )
+
+    assert status == 206
+    assert headers["Content-Range"] == f"bytes 1000-{len(ARCHIVE) - 1}/{len(ARCHIVE)}"
+    assert body == ARCHIVE[1000:]
+
+
+def test_download_head(fetch, standin):
+    status, headers, body = fetch("/repos/a/b/tarball/main", method="HEAD")
+
+    assert status == 200
+    assert headers["Content-Length"] == str(len(ARCHIVE))
+    assert body == b""
+    assert [path for _, path, _ in standin.requests] == [
+        "/repos/a/b/tarball/main",
+        "/archive?sig=1",
+    ]
+
+
+@pytest.mark.parametrize("method", ["GET", "HEAD"])
+def test_flask_download_closes_upstream_response(monkeypatch, standin, method):
+    import requests
+
+    from magicproxy import proxy
+
+    closed = []
+    close = requests.Response.close
+
+    def record_close(self):
+        closed.append(self.url)
+        close(self)
+
+    monkeypatch.setattr(requests.Response, "close", record_close)
+    monkeypatch.setattr(proxy, "keys", KEYS, raising=False)
+    monkeypatch.setattr(proxy, "GITHUB_API_ROOT", standin.api_root)
+    token = magictoken.create(
+        KEYS, "github token", ["GET /repos/a/b/.*", "HEAD /repos/a/b/.*"]
+    )
+
+    response = proxy.app.test_client().open(
+        "/repos/a/b/tarball/main",
+        method=method,
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    response.close()
+
+    assert f"{standin.asset_root}/archive?sig=1" in closed
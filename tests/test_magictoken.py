@@ -55,3 +55,36 @@ def test_get_from_env_and_decode():
 
     assert decoded.github_token == github_token
     assert scopes == scopes
+
+
+def test_create_and_decode_compact():
+    scopes = ["GET /user", "POST /repos/.+?/.+?/issues"]
+
+    result = magictoken.create(KEYS, "this is a token", scopes, compact=True)
+    decoded = magictoken.decode(KEYS, result)
+
+    assert decoded.scopes == scopes
+    assert decoded.scope_profile is None
+
+
+def test_create_and_decode_scope_profile():
+    result = magictoken.create(KEYS, "this is a token", None, scope_profile="ci:1")
+    decoded = magictoken.decode(KEYS, result)
+
+    assert decoded.github_token == "this is a token"
+    assert decoded.scopes == []
+    assert decoded.scope_profile == "ci:1"
+
+
+def test_keys_are_parsed_lazily():
+    keys = magictoken.Keys.from_files(
+        private_key_file=os.path.join(DATA, "private.pem"),
+        certificate_file=os.path.join(DATA, "public.x509.cer"),
+    )
+    assert keys._private_key is None
+    assert keys._certificate is None
+
+    result = magictoken.create(keys, "this is a token", ["GET /user"])
+
+    assert keys._private_key is not None
+    assert magictoken.decode(keys, result).github_token == "this is a token"
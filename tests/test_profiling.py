@@ -0,0 +1,196 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from magicproxy import capture
+from magicproxy import profiling
+
+
+def test_check_admin_token():
+    assert profiling.check_admin_token("secret", "Bearer secret")
+    assert profiling.check_admin_token("secret", "secret")
+    assert not profiling.check_admin_token("secret", "Bearer wrong")
+    assert not profiling.check_admin_token("secret", None)
+    assert not profiling.check_admin_token(None, "Bearer secret")
+    assert not profiling.check_admin_token("", "Bearer ")
+
+
+def _busy_worker(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampler_collects_collapsed_stacks():
+    stop = threading.Event()
+    thread = threading.Thread(target=_busy_worker, args=(stop,))
+    thread.start()
+    try:
+        stacks = profiling.Sampler(interval=0.001).sample(0.1)
+    finally:
+        stop.set()
+        thread.join()
+
+    lines = stacks.splitlines()
+    worker_lines = [
+        line for line in lines if "_busy_worker (test_profiling.py:" in line
+    ]
+    assert worker_lines
+    stack, count = worker_lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    # Outermost frame first.
+    assert stack.index("_bootstrap") < stack.index("_busy_worker")
+
+
+def test_sampler_runs_one_profile_at_a_time():
+    sampler = profiling.Sampler()
+    thread = threading.Thread(target=sampler.sample, args=(0.2,))
+    thread.start()
+    time.sleep(0.05)
+    try:
+        with pytest.raises(profiling.ProfilerBusy):
+            sampler.sample(0.01)
+    finally:
+        thread.join()
+
+
+def test_tracer_ignores_fast_requests():
+    tracer = profiling.SlowRequestTracer(threshold=10)
+    timer = capture.PhaseTimer()
+    timer.mark("decode")
+
+    assert tracer.check("GET", "/user", timer) is None
+    assert not tracer.recent
+
+
+def test_tracer_records_slow_requests():
+    tracer = profiling.SlowRequestTracer(threshold=0)
+    timer = capture.PhaseTimer()
+    timer.mark("decode")
+    timer.mark("scopes")
+    scope_timings = [("GET /user", 0.001), ("GET /(a+)+$", 0.5)]
+
+    trace = tracer.check("GET", "/user?page=", timer, scope_timings, "GET /(a+)+$")
+
+    assert trace["path"] == "/user?page="
+    assert sorted(trace["phases_ms"]) == ["decode", "scopes"]
+    assert trace["scope"] == "GET /(a+)+$"
+    assert trace["slowest_scope"] == {"scope": "GET /(a+)+$", "ms": 500.0}
+    assert list(tracer.recent) == [trace]
+
+
+def test_flask_app_traces_failed_requests(monkeypatch):
+    from magicproxy import proxy
+
+    tracer = profiling.SlowRequestTracer(threshold=0)
+    monkeypatch.setattr(proxy, "slow_request_tracer", tracer)
+    monkeypatch.setattr(proxy, "keys", None, raising=False)
+
+    response = proxy.app.test_client().get(
+        "/user", headers={"Authorization": "Bearer not a token"}
+    )
+
+    assert response.status_code == 500
+    assert [trace["path"] for trace in tracer.recent] == ["/user"]
+
+
+def test_aiohttp_app_traces_failed_requests(monkeypatch):
+    import aiohttp.test_utils
+    import aiohttp.web
+
+    from magicproxy import async_proxy
+
+    tracer = profiling.SlowRequestTracer(threshold=0)
+    monkeypatch.setattr(async_proxy, "slow_request_tracer", tracer)
+    monkeypatch.setattr(async_proxy, "keys", None, raising=False)
+
+    async def main():
+        app = aiohttp.web.Application()
+        app.add_routes(async_proxy.routes)
+        async with aiohttp.test_utils.TestClient(
+            aiohttp.test_utils.TestServer(app)
+        ) as client:
+            response = await client.get(
+                "/user", headers={"Authorization": "Bearer not a token"}
+            )
+            return response.status
+
+    assert asyncio.run(main()) == 500
+    assert [trace["path"] for trace in tracer.recent] == ["/user"]
+
+
+@pytest.mark.parametrize("method", ["GET", "HEAD"])
+def test_flask_app_traces_downloads_once_relayed(monkeypatch, method):
+    import http.server
+    import os
+
+    from magicproxy import magictoken
+    from magicproxy import proxy
+
+    class SlowBodyHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "20")
+            self.end_headers()
+
+        def do_GET(self):
+            self.do_HEAD()
+            self.wfile.write(b"x" * 10)
+            self.wfile.flush()
+            time.sleep(0.2)
+            self.wfile.write(b"x" * 10)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowBodyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    data = os.path.join(os.path.dirname(__file__), "data")
+    keys = magictoken.Keys.from_files(
+        os.path.join(data, "private.pem"), os.path.join(data, "public.x509.cer")
+    )
+    tracer = profiling.SlowRequestTracer(threshold=0)
+    monkeypatch.setattr(proxy, "keys", keys, raising=False)
+    monkeypatch.setattr(proxy, "slow_request_tracer", tracer)
+    monkeypatch.setattr(
+        proxy, "GITHUB_API_ROOT", f"http://127.0.0.1:{server.server_port}"
+    )
+    token = magictoken.create(keys, "github token", [f"{method} /repos/.*"])
+
+    try:
+        response = proxy.app.test_client().open(
+            "/repos/a/b/tarball/main",
+            method=method,
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        body = response.data
+        # As a WSGI server would once it's done with the response.
+        response.close()
+    finally:
+        server.shutdown()
+
+    (trace,) = tracer.recent
+    assert trace["path"] == "/repos/a/b/tarball/main"
+    if method == "GET":
+        assert len(body) == 20
+        assert trace["phases_ms"]["upstream"] >= 200
+    else:
+        assert body == b""
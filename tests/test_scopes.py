@@ -0,0 +1,212 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import functools
+import http.server
+import importlib
+import json
+import os
+import threading
+
+import pytest
+
+from magicproxy import magictoken
+from magicproxy import scopes
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+KEYS = magictoken.Keys.from_files(
+    private_key_file=os.path.join(DATA, "private.pem"),
+    certificate_file=os.path.join(DATA, "public.x509.cer"),
+)
+
+SCOPES = ["GET /user", "POST /repos/.+?/.+?/issues/.+?/labels", "* /gists"]
+
+
+def test_validate_request_with_list():
+    assert scopes.validate_request("GET", "user", SCOPES)
+    assert scopes.validate_request("POST", "/repos/a/b/issues/1/labels", SCOPES)
+    assert scopes.validate_request("DELETE", "/gists", SCOPES)
+    assert not scopes.validate_request("POST", "/user", SCOPES)
+
+
+def test_validate_request_with_profile():
+    profile = scopes.ScopeProfile("ci", 1, SCOPES)
+    assert profile.ref == "ci:1"
+    assert list(profile) == SCOPES
+
+    assert scopes.validate_request("GET", "user", profile)
+    assert scopes.validate_request("POST", "/repos/a/b/issues/1/labels", profile)
+    assert scopes.validate_request("DELETE", "/GISTS", profile)
+    assert not scopes.validate_request("POST", "/user", profile)
+
+
+def test_compact_round_trip():
+    original = SCOPES + ["PROPFIND /ünïcode", "GET /" + "x" * 300]
+    encoded = scopes.encode_compact(original)
+    assert scopes.decode_compact(encoded) == original
+
+
+def test_compact_is_smaller():
+    broad = [f"GET /repos/someorg/repo-{n}/issues" for n in range(100)]
+    assert len(scopes.encode_compact(broad)) < len(json.dumps(broad)) / 4
+
+
+def test_load_profiles(tmpdir):
+    config = tmpdir.join("profiles.json")
+    config.write(
+        json.dumps(
+            {
+                "profiles": [
+                    {"id": "ci", "version": 1, "scopes": ["GET /user"]},
+                    {"id": "ci", "version": 2, "scopes": SCOPES},
+                ]
+            }
+        )
+    )
+
+    profiles = scopes.load_profiles(str(config))
+
+    assert sorted(profiles) == ["ci:1", "ci:2"]
+    assert profiles["ci:2"].scopes == SCOPES
+    assert not scopes.validate_request("DELETE", "/gists", profiles["ci:1"])
+
+
+def test_load_profiles_rejects_duplicates(tmpdir):
+    config = tmpdir.join("profiles.json")
+    profile = {"id": "ci", "version": 1, "scopes": ["GET /user"]}
+    config.write(json.dumps({"profiles": [profile, profile]}))
+
+    with pytest.raises(ValueError):
+        scopes.load_profiles(str(config))
+
+
+def test_check_request_returns_deciding_scope():
+    assert scopes.check_request("DELETE", "/gists", SCOPES) == (True, "* /gists")
+    # A denied request reports the last pattern it was checked against.
+    assert scopes.check_request("GET", "/nope", SCOPES) == (False, "* /gists")
+    assert scopes.check_request("PATCH", "/nope", ["GET /user"]) == (False, None)
+
+    profile = scopes.ScopeProfile("ci", 1, SCOPES)
+    assert scopes.check_request("GET", "/user", profile) == (True, "GET /user")
+    assert scopes.check_request("GET", "/nope", profile) == (False, "* /gists")
+
+
+def test_validate_request_records_scope_timings():
+    timings = []
+    assert scopes.validate_request("DELETE", "/gists", SCOPES, timings=timings)
+    # Scopes for other methods are skipped without being evaluated.
+    assert [scope for scope, _ in timings] == ["* /gists"]
+
+    timings = []
+    profile = scopes.ScopeProfile("ci", 1, SCOPES)
+    assert not scopes.validate_request("GET", "/nope", profile, timings=timings)
+    assert [scope for scope, _ in timings] == ["GET /user", "* /gists"]
+    assert all(secs >= 0 for _, secs in timings)
+
+
+class _UpstreamHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # The aiohttp app streams the (empty) request body, so it's chunked.
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            while int(self.rfile.readline(), 16):
+                pass
+            self.rfile.readline()
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _send_flask(module, method, path, headers=None, json=None):
+    response = module.app.test_client().open(
+        path, method=method, headers=headers, json=json
+    )
+    return response.status_code, response.data
+
+
+def _send_aiohttp(module, method, path, headers=None, json=None):
+    import aiohttp.test_utils
+    import aiohttp.web
+
+    async def main():
+        app = aiohttp.web.Application()
+        app.add_routes(module.routes)
+        async with aiohttp.test_utils.TestClient(
+            aiohttp.test_utils.TestServer(app)
+        ) as client:
+            response = await client.request(method, path, headers=headers, json=json)
+            return response.status, await response.read()
+
+    return asyncio.run(main())
+
+
+@pytest.fixture(
+    params=[("proxy", _send_flask, 401), ("async_proxy", _send_aiohttp, 403)],
+    ids=["proxy", "async_proxy"],
+)
+def app(request, monkeypatch):
+    """Returns a function that sends a request to one of the apps, the status
+    it uses for denied requests and the GitHub stand-in it proxies to."""
+    server, send, denied_status = request.param
+    module = importlib.import_module(f"magicproxy.{server}")
+
+    upstream = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _UpstreamHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+
+    monkeypatch.setattr(module, "keys", KEYS, raising=False)
+    monkeypatch.setattr(
+        module, "scope_profiles", {"ci:1": scopes.ScopeProfile("ci", 1, ["GET /user"])}
+    )
+    monkeypatch.setattr(
+        module, "GITHUB_API_ROOT", f"http://127.0.0.1:{upstream.server_port}"
+    )
+
+    yield functools.partial(send, module), denied_status
+
+    upstream.shutdown()
+
+
+@pytest.mark.parametrize("scope_profile", ["ci:2", 1])
+def test_apps_reject_bad_scope_profiles(app, scope_profile):
+    send, _ = app
+
+    status, _ = send(
+        "POST",
+        "/magictoken",
+        json={"github_token": "github token", "scope_profile": scope_profile},
+    )
+
+    assert status == 400
+
+
+def test_apps_check_requests_against_scope_profiles(app):
+    send, denied_status = app
+
+    status, token = send(
+        "POST",
+        "/magictoken",
+        json={"github_token": "github token", "scope_profile": "ci:1"},
+    )
+    assert status == 200
+    headers = {"Authorization": f"Bearer {token.decode()}"}
+
+    assert send("GET", "/user", headers=headers) == (200, b"{}")
+    status, _ = send("DELETE", "/user", headers=headers)
+    assert status == denied_status
@@ -0,0 +1,181 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import hashlib
+import importlib
+import os
+import time
+
+import pytest
+
+from magicproxy import magictoken
+from magicproxy import tokencache
+
+HERE = os.path.dirname(__file__)
+DATA = os.path.join(HERE, "data")
+KEYS = magictoken.Keys.from_files(
+    private_key_file=os.path.join(DATA, "private.pem"),
+    certificate_file=os.path.join(DATA, "public.x509.cer"),
+)
+FUTURE = int(time.time()) + 3600
+
+
+def test_put_and_get():
+    cache = tokencache.SharedTokenCache(slots=16)
+    payload = {"github_token": "secret", "scopes": ["GET /user"]}
+
+    assert cache.get("token") is None
+    assert cache.put("token", payload, FUTURE)
+    assert cache.get("token") == payload
+    assert cache.get("other token") is None
+
+
+def test_payload_is_not_stored_in_the_clear():
+    cache = tokencache.SharedTokenCache(slots=16)
+    cache.put("token", {"github_token": "secret", "scopes": []}, FUTURE)
+
+    assert b"secret" not in bytes(cache._mmap)
+
+
+def test_expired_entries_are_misses():
+    cache = tokencache.SharedTokenCache(slots=16)
+    cache.put("token", {"github_token": "secret", "scopes": []}, int(time.time()) - 1)
+
+    assert cache.get("token") is None
+
+
+def test_oversized_payloads_are_not_cached():
+    cache = tokencache.SharedTokenCache(slots=16, slot_size=128)
+    payload = {"github_token": "secret", "scopes": ["GET /user"] * 100}
+
+    assert not cache.put("token", payload, FUTURE)
+    assert cache.get("token") is None
+
+
+def test_eviction_keeps_table_bounded():
+    cache = tokencache.SharedTokenCache(slots=tokencache.PROBE_WINDOW)
+    for n in range(100):
+        cache.put(f"token-{n}", {"github_token": str(n), "scopes": []}, FUTURE)
+
+    # The most recent write always survives, older ones are evicted.
+    assert cache.get("token-99") == {"github_token": "99", "scopes": []}
+    hits = [n for n in range(100) if cache.get(f"token-{n}") is not None]
+    assert len(hits) <= tokencache.PROBE_WINDOW
+
+
+def test_recently_used_entries_survive_eviction():
+    cache = tokencache.SharedTokenCache(slots=tokencache.PROBE_WINDOW)
+    for n in range(tokencache.PROBE_WINDOW):
+        cache.put(f"token-{n}", {"github_token": str(n), "scopes": []}, FUTURE)
+
+    # Mark every entry but one as referenced; that one must be the victim.
+    for n in range(1, tokencache.PROBE_WINDOW):
+        cache.get(f"token-{n}")
+    cache.put("new-token", {"github_token": "new", "scopes": []}, FUTURE)
+
+    assert cache.get("token-0") is None
+    for n in range(1, tokencache.PROBE_WINDOW):
+        assert cache.get(f"token-{n}") is not None
+
+
+def test_rewrites_replace_the_existing_entry(monkeypatch):
+    cache = tokencache.SharedTokenCache(slots=tokencache.PROBE_WINDOW)
+    now = int(time.time())
+    for n in range(tokencache.PROBE_WINDOW):
+        cache.put(f"filler-{n}", {"github_token": str(n), "scopes": []}, now + 10)
+    # Move the clock hand so that the token doesn't land first in its window.
+    tokencache._TABLE_HEADER.pack_into(cache._mmap, 0, 1)
+    cache.put("token", {"github_token": "old", "scopes": []}, FUTURE)
+
+    # Once the fillers expire, rewriting the token must still use its slot.
+    monkeypatch.setattr(tokencache.time, "time", lambda: now + 20)
+    cache.put("token", {"github_token": "new", "scopes": []}, FUTURE)
+
+    digest = hashlib.sha256(b"token").digest()
+    assert bytes(cache._mmap).count(digest) == 1
+    assert cache.get("token") == {"github_token": "new", "scopes": []}
+
+
+def test_put_is_skipped_when_lock_is_held(monkeypatch):
+    monkeypatch.setattr(tokencache, "LOCK_TIMEOUT", 0.01)
+    cache = tokencache.SharedTokenCache(slots=16)
+
+    # As if a worker died while holding the lock.
+    cache._lock.acquire()
+    assert not cache.put("token", {"github_token": "secret", "scopes": []}, FUTURE)
+    assert cache.get("token") is None
+
+    cache._lock.release()
+    assert cache.put("token", {"github_token": "secret", "scopes": []}, FUTURE)
+
+
+def test_entries_are_shared_with_forked_workers():
+    cache = tokencache.SharedTokenCache(slots=16)
+
+    pid = os.fork()
+    if pid == 0:
+        cache.put("token", {"github_token": "from child", "scopes": []}, FUTURE)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert cache.get("token") == {"github_token": "from child", "scopes": []}
+
+
+@pytest.mark.parametrize("server", ["proxy", "async_proxy"])
+def test_apps_share_cache_with_forked_workers(monkeypatch, server):
+    monkeypatch.setenv("MAGICPROXY_TOKEN_CACHE_SLOTS", "16")
+    monkeypatch.setenv("MAGICPROXY_PRIVATE_KEY", os.path.join(DATA, "private.pem"))
+    monkeypatch.setenv("MAGICPROXY_PUBLIC_KEY", os.path.join(DATA, "public.x509.cer"))
+    # Loading the app in the parent is what gunicorn's --preload does.
+    module = importlib.reload(importlib.import_module(f"magicproxy.{server}"))
+
+    try:
+        pid = os.fork()
+        if pid == 0:
+            # Without --preload (and always for aiohttp), the app is
+            # configured in each worker after the fork.
+            if server == "proxy":
+                module.create_app()
+            else:
+                asyncio.run(module.build_app())
+            module.token_cache.put(
+                "token", {"github_token": "from worker", "scopes": []}, FUTURE
+            )
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        assert module.token_cache.get("token") == {
+            "github_token": "from worker",
+            "scopes": [],
+        }
+    finally:
+        monkeypatch.undo()
+        importlib.reload(module)
+
+
+def test_decode_uses_cache():
+    cache = tokencache.SharedTokenCache(slots=16)
+    token = magictoken.create(KEYS, "this is a token", ["GET /user"])
+
+    decoded = magictoken.decode(KEYS, token, cache=cache)
+    assert cache.get(token) == {
+        "github_token": "this is a token",
+        "scopes": ["GET /user"],
+        "scope_profile": None,
+    }
+
+    # Served from the cache, so the keys are never consulted.
+    cached = magictoken.decode(None, token, cache=cache)
+    assert cached == decoded
@@ -0,0 +1,368 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import concurrent.futures
+import http.server
+import os
+import threading
+
+import pytest
+
+h2 = pytest.importorskip("h2")
+pytest.importorskip("httpx")
+
+import h2.config  # noqa: E402
+import h2.connection  # noqa: E402
+import h2.events  # noqa: E402
+import h2.exceptions  # noqa: E402
+
+from magicproxy import magictoken  # noqa: E402
+from magicproxy import upstream  # noqa: E402
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+KEYS = magictoken.Keys.from_files(
+    private_key_file=os.path.join(DATA, "private.pem"),
+    certificate_file=os.path.join(DATA, "public.x509.cer"),
+)
+TOKEN = magictoken.create(KEYS, "github token", ["GET /user", "POST /user/repos"])
+AUTHORIZATION = {"Authorization": f"Bearer {TOKEN}"}
+
+
+class H2StandIn:
+    """A plaintext (h2c) HTTP/2 server that records how it's used."""
+
+    def __init__(self, delay=0.05, broken_connections=0):
+        self.delay = delay
+        # The first connections drop as soon as a request arrives.
+        self.broken_connections = broken_connections
+        self.connections = 0
+        self.max_streams = 0
+        self.request_headers = []
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        threading.Thread(target=self._run, args=(ready,), daemon=True).start()
+        ready.wait()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self._loop)
+        server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, "127.0.0.1", 0)
+        )
+        self.port = server.sockets[0].getsockname()[1]
+        ready.set()
+        self._loop.run_forever()
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _handle(self, reader, writer):
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        writer.write(conn.data_to_send())
+        self.connections += 1
+        broken = self.connections <= self.broken_connections
+        active = set()
+
+        while True:
+            data = await reader.read(65535)
+            if not data:
+                break
+            try:
+                events = conn.receive_data(data)
+            except h2.exceptions.ProtocolError:
+                break
+
+            if broken and any(
+                isinstance(event, h2.events.RequestReceived) for event in events
+            ):
+                break
+
+            for event in events:
+                if isinstance(event, h2.events.RequestReceived):
+                    active.add(event.stream_id)
+                    self.max_streams = max(self.max_streams, len(active))
+                    self.request_headers.append(dict(event.headers))
+                elif isinstance(event, h2.events.DataReceived):
+                    conn.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id
+                    )
+                elif isinstance(event, h2.events.StreamEnded):
+                    asyncio.ensure_future(
+                        self._respond(conn, writer, event.stream_id, active)
+                    )
+
+            writer.write(conn.data_to_send())
+
+        writer.close()
+
+    async def _respond(self, conn, writer, stream_id, active):
+        await asyncio.sleep(self.delay)
+        body = b'{"ok": true}'
+        conn.send_headers(
+            stream_id,
+            [
+                (":status", "200"),
+                ("content-type", "application/json"),
+                ("content-length", str(len(body))),
+            ],
+        )
+        conn.send_data(stream_id, body, end_stream=True)
+        active.discard(stream_id)
+        writer.write(conn.data_to_send())
+
+
+class Http1Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def h2_standin():
+    server = H2StandIn()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def http1_standin():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Http1Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_async_requests_are_multiplexed(h2_standin):
+    client = upstream.AsyncHttp2Upstream(
+        connections=2, streams_per_connection=5, prior_knowledge=True
+    )
+
+    async def fetch():
+        async with client.stream("GET", f"{h2_standin.url}/user", {}) as response:
+            await response.aread()
+            return response.status_code, response.http_version
+
+    async def main():
+        try:
+            return await asyncio.gather(*(fetch() for _ in range(30)))
+        finally:
+            await client.aclose()
+
+    results = asyncio.run(main())
+
+    assert results == [(200, "HTTP/2")] * 30
+    assert h2_standin.connections == 2
+    assert 1 < h2_standin.max_streams <= 5
+    assert client.http2
+
+
+def test_sync_requests_are_multiplexed(h2_standin):
+    client = upstream.Http2Upstream(
+        connections=2, streams_per_connection=5, prior_knowledge=True
+    )
+
+    def fetch(_):
+        response = client.request("GET", f"{h2_standin.url}/user", {})
+        return response.status_code, response.http_version
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+        results = list(executor.map(fetch, range(30)))
+    client.close()
+
+    assert results == [(200, "HTTP/2")] * 30
+    assert h2_standin.connections <= 2
+    assert h2_standin.max_streams <= 5
+
+
+def test_connection_headers_are_not_sent(h2_standin):
+    client = upstream.Http2Upstream(connections=1, prior_knowledge=True)
+
+    response = client.request(
+        "GET",
+        f"{h2_standin.url}/user",
+        {"Connection": "keep-alive", "Host": "example.com", "Accept": "*/*"},
+    )
+    client.close()
+
+    assert response.status_code == 200
+    sent = h2_standin.request_headers[0]
+    assert b"connection" not in sent
+    assert sent[b"accept"] == b"*/*"
+
+
+def test_falls_back_to_http1(http1_standin):
+    client = upstream.Http2Upstream(connections=2)
+
+    first = client.request("GET", f"{http1_standin}/user", {})
+    second = client.request("GET", f"{http1_standin}/user", {})
+    client.close()
+
+    assert first.status_code == second.status_code == 200
+    assert second.http_version == "HTTP/1.1"
+    assert not client.http2
+
+
+def test_idempotent_requests_are_retried_on_a_new_connection():
+    server = H2StandIn(broken_connections=1)
+    client = upstream.Http2Upstream(connections=1, prior_knowledge=True)
+
+    response = client.request("GET", f"{server.url}/user", {})
+    client.close()
+    server.close()
+
+    assert response.status_code == 200
+    assert response.http_version == "HTTP/2"
+    assert server.connections == 2
+    assert client.http2
+
+
+def test_async_idempotent_requests_are_retried_on_a_new_connection():
+    server = H2StandIn(broken_connections=1)
+    client = upstream.AsyncHttp2Upstream(connections=1, prior_knowledge=True)
+
+    async def main():
+        try:
+            async with client.stream("GET", f"{server.url}/user", {}) as response:
+                await response.aread()
+                return response.status_code, response.http_version
+        finally:
+            await client.aclose()
+
+    result = asyncio.run(main())
+    server.close()
+
+    assert result == (200, "HTTP/2")
+    assert server.connections == 2
+    assert client.http2
+
+
+def test_other_requests_are_not_retried():
+    server = H2StandIn(broken_connections=1)
+    client = upstream.Http2Upstream(connections=1, prior_knowledge=True)
+
+    with pytest.raises(upstream.UpstreamConnectionError):
+        client.request("POST", f"{server.url}/user/repos", {}, content=b"{}")
+
+    # The next request gets a new connection and still uses HTTP/2.
+    response = client.request("POST", f"{server.url}/user/repos", {}, content=b"{}")
+    client.close()
+    server.close()
+
+    assert response.http_version == "HTTP/2"
+    assert server.connections == 2
+    assert client.http2
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.delenv("MAGICPROXY_UPSTREAM_HTTP2", raising=False)
+    assert upstream.from_env() is None
+
+    monkeypatch.setenv("MAGICPROXY_UPSTREAM_HTTP2", "1")
+    monkeypatch.setenv("MAGICPROXY_UPSTREAM_HTTP2_CONNECTIONS", "3")
+    client = upstream.from_env()
+
+    assert isinstance(client, upstream.Http2Upstream)
+    assert client.connections == 3
+    client.close()
+
+
+def _configure_app(monkeypatch, module, server, client):
+    monkeypatch.setattr(module, "keys", KEYS, raising=False)
+    monkeypatch.setattr(module, "GITHUB_API_ROOT", server.url)
+    monkeypatch.setattr(module, "http2_upstream", client)
+
+
+def _fetch_flask(monkeypatch, server, method, path):
+    from magicproxy import proxy
+
+    client = upstream.Http2Upstream(connections=1, prior_knowledge=True)
+    _configure_app(monkeypatch, proxy, server, client)
+    try:
+        response = proxy.app.test_client().open(
+            path, method=method, headers=AUTHORIZATION, data=b"{}"
+        )
+        return response.status_code, response.data
+    finally:
+        client.close()
+
+
+def _fetch_aiohttp(monkeypatch, server, method, path):
+    import aiohttp.test_utils
+    import aiohttp.web
+
+    from magicproxy import async_proxy
+
+    client = upstream.AsyncHttp2Upstream(connections=1, prior_knowledge=True)
+    _configure_app(monkeypatch, async_proxy, server, client)
+
+    async def fetch():
+        app = aiohttp.web.Application()
+        app.add_routes(async_proxy.routes)
+        try:
+            async with aiohttp.test_utils.TestClient(
+                aiohttp.test_utils.TestServer(app)
+            ) as test_client:
+                response = await test_client.request(
+                    method, path, headers=AUTHORIZATION, data=b"{}"
+                )
+                return response.status, await response.read()
+        finally:
+            await client.aclose()
+
+    return asyncio.run(fetch())
+
+
+@pytest.fixture(params=["proxy", "async_proxy"])
+def fetch_from_app(request, monkeypatch):
+    """Returns a function that sends a request through one of the apps, with
+    the HTTP/2 upstream pointed at a stand-in."""
+    fetch = _fetch_flask if request.param == "proxy" else _fetch_aiohttp
+
+    def fetch_from_app(server, method, path):
+        return fetch(monkeypatch, server, method, path)
+
+    return fetch_from_app
+
+
+def test_apps_proxy_over_http2(fetch_from_app, h2_standin):
+    status, body = fetch_from_app(h2_standin, "GET", "/user")
+
+    assert status == 200
+    assert body == b'{"ok": true}'
+    sent = h2_standin.request_headers[0]
+    assert sent[b":path"] == b"/user"
+    assert sent[b"authorization"] == b"Bearer github token"
+
+
+def test_apps_return_bad_gateway_for_broken_connections(fetch_from_app):
+    server = H2StandIn(broken_connections=1)
+
+    status, body = fetch_from_app(server, "POST", "/user/repos")
+    server.close()
+
+    assert status == 502
+    assert body == b"Connection to GitHub failed."